@@ -0,0 +1,47 @@
+#!python
+
+# compares save time, load time and file size of the quote snapshot codecs on a
+# synthetic archive.
+#
+#     python benchmarks/bench_codecs.py [--quotes N]
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import vebyastquotebot.quotecodecs
+import vebyastquotebot.storage
+import synthetic
+
+def timed(f):
+    start = time.perf_counter()
+    result = f()
+    return (result, time.perf_counter() - start)
+
+def load(codec, filename):
+    with open(filename, 'rb' if codec.binary else 'r') as f:
+        return codec.load(f)
+
+def main():
+    argparser = argparse.ArgumentParser(description='benchmark quote snapshot codecs')
+    argparser.add_argument('--quotes', type=int, default=100000)
+    args = argparser.parse_args()
+
+    quotes = synthetic.make_quotes(args.quotes)
+    print('{} quotes, {} lines'.format(len(quotes), sum(len(q['lines']) for q in quotes)))
+    print('{:15} {:>10} {:>10} {:>10}'.format('codec', 'save s', 'load s', 'MiB'))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for (name, codec) in sorted(vebyastquotebot.quotecodecs.CODECS.items()):
+            filename = os.path.join(tmpdir, 'quotes' + codec.suffix)
+            (_, save_time) = timed(lambda: vebyastquotebot.storage.write_snapshot(filename, quotes, codec))
+            (loaded, load_time) = timed(lambda: load(codec, filename))
+            assert loaded == quotes
+            print('{:15} {:10.2f} {:10.2f} {:10.1f}'.format(
+                name, save_time, load_time, os.path.getsize(filename) / 2 ** 20))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+#!python
+
+# drives main.py's on_message end to end against an in-process fake discord
+# client (see fakediscord.py) and a synthetic quote archive, and reports
+# latency percentiles per command. nothing touches the network or git: the
+# quote database runs at QUOTE_DB_COMMIT=FS in a temporary directory.
+#
+#     python benchmarks/bench_commands.py [--quotes N] [--history N] [--latency S] [--runs N]
+
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import vebyastquotebot.commandparse
+import vebyastquotebot.storage
+import fakediscord
+import synthetic
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    rank = max(0, int(round(p / 100 * len(sorted_values))) - 1)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+def setup_bot(tmpdir, args):
+    vebyastquotebot.storage.write_snapshot(
+        os.path.join(tmpdir, 'quotes.json'),
+        synthetic.make_quotes(args.quotes, seed=args.seed),
+    )
+    os.chdir(tmpdir)
+    os.environ.update({
+        'QUOTE_DB_COMMIT': 'FS',
+        'QUOTE_DB_STORAGE': args.storage,
+        'DISCORD_BOT_TOKEN': 'not-a-token',
+        'USER_INTERFACE_URL': 'http://localhost/',
+        'QUOTE_INDEX_DIR': os.path.join(tmpdir, 'quotes.idx'),
+    })
+    import main
+    # main logs every command at INFO, which would swamp the results
+    logging.getLogger().setLevel(logging.WARNING)
+
+    client = fakediscord.FakeClient(
+        latency=args.latency,
+        rate=args.rate,
+        per=args.per,
+        seed=args.seed,
+        loop=asyncio.get_event_loop(),
+    )
+    main.client = client
+    client.listener = main.on_message
+    main.GRAMMAR = vebyastquotebot.commandparse.CommandGrammar(client.user.id, main.COMMANDS.keys())
+    return (main, client)
+
+def fill_channel(client, channel, users, n, rng):
+    start = client.clock
+    for i in range(n):
+        content = '{} tok{}'.format(' '.join(rng.choice(synthetic.WORDS) for _ in range(rng.randint(1, 20))), i)
+        client.post(channel, rng.choice(users), content, when=start + datetime.timedelta(seconds=i))
+
+class Workload(object):
+    def __init__(self, main, client, channel, users, rng, args):
+        self.main = main
+        self.client = client
+        self.channel = channel
+        self.users = users
+        self.rng = rng
+        self.args = args
+        self.mention = '<@{}>'.format(client.user.id)
+        self.history = list(channel.messages)
+        self.quote_ids = list(main.QUOTE_STORE.index)
+        rng.shuffle(self.quote_ids)
+
+    def recent_range(self):
+        # somewhere in the most recent user messages, well inside DEFAULT_LIMIT
+        window = self.history[-min(len(self.history), self.main.DEFAULT_LIMIT // 2):]
+        end = self.rng.randrange(self.args.quote_length, len(window))
+        return (window[end - self.args.quote_length], window[end])
+
+    def token(self, message):
+        return message.content.rsplit(' ', 1)[1]
+
+    def command_text(self, mode):
+        if mode == 'add-id':
+            (start, end) = self.recent_range()
+            return '/add -S {} -E {}'.format(start.id, end.id)
+        if mode == 'add-query':
+            (start, end) = self.recent_range()
+            return '/add -s "{}" -e "{}"'.format(self.token(start), self.token(end))
+        if mode == 'get':
+            return '/get {}'.format(self.rng.choice(self.quote_ids))
+        if mode == 'remove':
+            return '/remove {}'.format(self.quote_ids.pop())
+        if mode == 'clean':
+            return '/clean -n {}'.format(self.args.clean_count)
+        raise ValueError(mode)
+
+    async def run(self, mode):
+        text = '{} {}'.format(self.mention, self.command_text(mode))
+        message = self.client.post(self.channel, self.rng.choice(self.users), text)
+        start = time.perf_counter()
+        if mode != 'clean':
+            await self.main.on_message(message)
+            return time.perf_counter() - start
+
+        # /clean sits around for a while before deleting its own feedback, so
+        # it's done as far as anyone can tell once it reports what it deleted
+        done = self.client.wait_for_edit(None, lambda content: content.startswith('Deleted'))
+        task = asyncio.ensure_future(self.main.on_message(message))
+        await done
+        elapsed = time.perf_counter() - start
+        task.cancel()
+        return elapsed
+
+MODES = ['add-id', 'add-query', 'get', 'remove', 'clean']
+
+async def run_all(workload, modes, runs, concurrency):
+    results = {mode: [] for mode in modes}
+    for mode in modes:
+        for i in range(0, runs, concurrency):
+            batch = await asyncio.gather(*(workload.run(mode) for _ in range(min(concurrency, runs - i))))
+            results[mode].extend(batch)
+    return results
+
+def main():
+    argparser = argparse.ArgumentParser(description='benchmark bot commands against a fake discord client')
+    argparser.add_argument('--quotes', type=int, default=5000, help='size of the synthetic quotes.json')
+    argparser.add_argument('--history', type=int, default=3000, help='messages in the synthetic channel')
+    argparser.add_argument('--latency', type=float, default=0.05, help='mean seconds per discord round trip')
+    argparser.add_argument('--rate', type=int, default=5, help='calls per endpoint and channel per --per seconds (0: unlimited)')
+    argparser.add_argument('--per', type=float, default=5.0)
+    argparser.add_argument('--runs', type=int, default=10, help='commands per mode')
+    argparser.add_argument('--concurrency', type=int, default=1, help='commands of a mode in flight at once')
+    argparser.add_argument('--quote-length', type=int, default=10, help='lines per /add')
+    argparser.add_argument('--clean-count', type=int, default=100)
+    argparser.add_argument('--storage', default='SNAPSHOT')
+    argparser.add_argument('--modes', nargs='+', default=MODES, choices=MODES)
+    argparser.add_argument('--seed', type=int, default=0)
+    args = argparser.parse_args()
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        (main_module, client) = setup_bot(tmpdir, args)
+        server = fakediscord.FakeServer('500000000000000000', 'Test Server')
+        channel = client.add_channel('general', server)
+        users = [client.add_user('user{}'.format(i)) for i in range(20)]
+        fill_channel(client, channel, users, args.history, rng)
+
+        workload = Workload(main_module, client, channel, users, rng, args)
+        loop = asyncio.get_event_loop()
+        results = loop.run_until_complete(run_all(workload, args.modes, args.runs, args.concurrency))
+
+        print('{} quotes, {} messages of history, {:.0f}ms mean latency, {} calls/{}s rate limit'.format(
+            args.quotes, args.history, args.latency * 1000, args.rate, args.per))
+        print('{:12} {:>6} {:>10} {:>10} {:>10} {:>10}'.format('command', 'n', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+        for mode in args.modes:
+            values = sorted(results[mode])
+            print('{:12} {:6} {:10.1f} {:10.1f} {:10.1f} {:10.1f}'.format(
+                mode, len(values),
+                *(1000 * v for v in [percentile(values, 50), percentile(values, 90), percentile(values, 99), values[-1]])))
+        print('discord calls: {}'.format(', '.join('{} {}'.format(k, v) for (k, v) in sorted(client.calls.items()))))
+        print('rate limited: {}'.format(', '.join('{} {}'.format(k, v) for (k, v) in sorted(client.limiter.throttled.items())) or 'never'))
+        os.chdir(ROOT)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!python
+
+# compares the memory held by a loaded quote archive as plain json dicts versus
+# the compact records QuoteDB keeps in memory, and checks that the compact form
+# serializes back to exactly the same json.
+#
+#     python benchmarks/bench_compact.py [--quotes N]
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import vebyastquotebot.compact
+import synthetic
+
+def measure(build):
+    # timed separately, since tracing allocations slows everything down a lot
+    start = time.perf_counter()
+    build()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    result = build()
+    (current, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (result, current, elapsed)
+
+def main():
+    argparser = argparse.ArgumentParser(description='benchmark compact quote records')
+    argparser.add_argument('--quotes', type=int, default=20000)
+    args = argparser.parse_args()
+
+    # round-trip through a string, like loading quotes.json does, so that no
+    # strings are shared by accident
+    encoded = json.dumps(synthetic.make_quotes(args.quotes), indent=2)
+
+    (dicts, dict_bytes, dict_time) = measure(lambda: json.loads(encoded))
+    (records, record_bytes, record_time) = measure(lambda: [
+        vebyastquotebot.compact.from_json(q) for q in json.loads(encoded)
+    ])
+
+    assert json.dumps([vebyastquotebot.compact.to_json(r) for r in records], indent=2) == encoded
+    nlines = sum(len(q['lines']) for q in dicts)
+
+    print('{} quotes, {} lines, {} distinct authors'.format(
+        len(dicts), nlines, len(vebyastquotebot.compact.AUTHORS)))
+    print('{:20} {:>12} {:>12} {:>10}'.format('representation', 'MiB', 'bytes/line', 'load s'))
+    for (name, nbytes, elapsed) in [('json dicts', dict_bytes, dict_time), ('compact records', record_bytes, record_time)]:
+        print('{:20} {:12.1f} {:12.0f} {:10.2f}'.format(name, nbytes / 2 ** 20, nbytes / nlines, elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!python
+
+# measures how long concurrent /add-shaped commands hold up the event loop,
+# with everything running on the loop (the way it used to) and with the
+# executor pools. each add saves a big quote into a big archive, updates the
+# full-text search index and gets committed to a scratch git repo; meanwhile a
+# sampler asks the loop to wake it every few milliseconds and records how late
+# it was.
+#
+#     python benchmarks/bench_loop_lag.py [--quotes N] [--adds N] [--lines N] [--storage SNAPSHOT|JOURNAL|SQLITE]
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import git
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import vebyastquotebot.executors
+import vebyastquotebot.gitwriter
+import vebyastquotebot.quotedb
+import vebyastquotebot.quotesearch
+import vebyastquotebot.storage
+import synthetic
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    rank = max(0, int(round(p / 100 * len(sorted_values))) - 1)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+async def sample_lag(lags, interval, done):
+    loop = asyncio.get_event_loop()
+    while not done.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - start - interval)
+
+async def add(store, gitwriter, quote, latency):
+    # stands in for the Discord round trips around the save
+    await asyncio.sleep(latency)
+    async with vebyastquotebot.quotedb.QuoteDB(
+            docommit=vebyastquotebot.quotedb.QuoteDBCommit.COMMIT,
+            commit_message='Add quote {}'.format(quote['id']),
+            store=store,
+            gitwriter=gitwriter,
+    ) as quote_db:
+        quote_db.add_quote(quote)
+    await asyncio.sleep(latency)
+    return await quote_db.git_status
+
+def setup_repo(tmpdir, initial):
+    filename = os.path.join(tmpdir, 'quotes.json')
+    vebyastquotebot.storage.write_snapshot(filename, initial)
+    repo = git.Repo.init(tmpdir)
+    with repo.config_writer() as config:
+        config.set_value('user', 'name', 'bench')
+        config.set_value('user', 'email', 'bench@example.com')
+    repo.index.add([filename])
+    repo.index.commit('initial quotes')
+    return filename
+
+def run(mode, args, initial, added):
+    (threads, processes) = {
+        'loop': (0, 0),
+        'pools': (args.threads, args.processes),
+    }[mode]
+    vebyastquotebot.executors.EXECUTORS.configure(threads=threads, processes=processes)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = setup_repo(tmpdir, initial)
+        kind = vebyastquotebot.quotedb.QuoteDBStorage[args.storage]
+        store = vebyastquotebot.quotedb.QuoteStore(filename, vebyastquotebot.quotedb.make_storage(kind, filename))
+        index = vebyastquotebot.quotesearch.QuoteIndex(os.path.join(tmpdir, 'quotes.idx'))
+        store.add_listener(index)
+        # loading and the initial index build happen before the loop starts,
+        # same as in main.py
+        store.refresh()
+        gitwriter = vebyastquotebot.gitwriter.GitWriter(store, delay=args.commit_delay)
+
+        async def workload():
+            lags = []
+            done = asyncio.Event()
+            sampler = asyncio.ensure_future(sample_lag(lags, args.interval, done))
+            start = time.perf_counter()
+            statuses = await asyncio.gather(*[add(store, gitwriter, quote, args.latency) for quote in added])
+            await index.flush()
+            elapsed = time.perf_counter() - start
+            done.set()
+            await sampler
+            return (lags, statuses, elapsed)
+
+        (lags, statuses, elapsed) = asyncio.get_event_loop().run_until_complete(workload())
+        vebyastquotebot.executors.EXECUTORS.shutdown()
+
+        found = index.search('quote_id:({})'.format(' OR '.join(q['id'] for q in added[:20])), pagelen=20).total
+        if found != min(20, len(added)):
+            print('{}: only {} of the added quotes made it into the search index'.format(mode, found))
+            sys.exit(1)
+
+    lags = sorted(lags)
+    print('{:>6}: {} adds in {:.2f}s ({} commits), loop lag p50 {:.1f}ms p90 {:.1f}ms p99 {:.1f}ms max {:.1f}ms'.format(
+        mode, len(added), elapsed, len(set(statuses)),
+        *(1000 * v for v in [percentile(lags, 50), percentile(lags, 90), percentile(lags, 99), lags[-1]])))
+
+def main():
+    argparser = argparse.ArgumentParser(description='measure event loop lag under concurrent adds')
+    argparser.add_argument('--quotes', type=int, default=5000, help='size of the starting archive')
+    argparser.add_argument('--adds', type=int, default=50)
+    argparser.add_argument('--lines', type=int, default=200, help='average lines per added quote')
+    argparser.add_argument('--latency', type=float, default=0.05, help='seconds per fake Discord call')
+    argparser.add_argument('--interval', type=float, default=0.005, help='seconds between lag samples')
+    argparser.add_argument('--commit-delay', type=float, default=0.5)
+    argparser.add_argument('--storage', default='SNAPSHOT',
+                           choices=[s.name for s in vebyastquotebot.quotedb.QuoteDBStorage])
+    argparser.add_argument('--threads', type=int, default=4)
+    argparser.add_argument('--processes', type=int, default=1)
+    argparser.add_argument('--modes', default='loop,pools')
+    argparser.add_argument('--seed', type=int, default=0)
+    args = argparser.parse_args()
+
+    initial = synthetic.make_quotes(args.quotes, seed=args.seed)
+    added = [
+        dict(q, id='new-{}'.format(i))
+        for (i, q) in enumerate(synthetic.make_quotes(args.adds, lines=args.lines, seed=args.seed + 1))
+    ]
+    for mode in args.modes.split(','):
+        run(mode, args, initial, added)
+
+if __name__ == '__main__':
+    main()
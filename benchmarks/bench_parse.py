@@ -0,0 +1,70 @@
+#!python
+
+# measures how many messages per second get through on_message's rejection
+# path (a message in a server that doesn't mention the bot), comparing the
+# precompiled grammar against building the grammar per message like the bot
+# used to.
+#
+#     python benchmarks/bench_parse.py [--messages N]
+
+import argparse
+import functools
+import os
+import random
+import sys
+import time
+
+import pyparsing as ps
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import vebyastquotebot.commandparse
+
+USER_ID = '123456789012345678'
+COMMANDS = ['/add', '/remove', '/get', '/clean', '/clear', '/help', 'help', '--help']
+
+WORDS = 'the quick brown fox jumps over lazy dog lol what did you mean by that <@987654321098765432>'.split()
+
+def chat_messages(n, seed=0):
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 30))) for _ in range(n)]
+
+def rebuilt_public_message_parse(command_line):
+    try:
+        parseresult = (
+            ('<@' + ps.Optional('!') + USER_ID + '>').setResultsName('user_id')
+            + ps.restOfLine.setResultsName('command_line')
+        ).parseString(command_line)
+        return (parseresult['command_line'], None)
+    except ps.ParseException as e:
+        return (None, e)
+
+def parse_or_none(grammar, command_line):
+    try:
+        return grammar.parseString(command_line)
+    except ps.ParseException:
+        return None
+
+def run(parse, messages):
+    start = time.perf_counter()
+    for m in messages:
+        parse(m)
+    return len(messages) / (time.perf_counter() - start)
+
+def main():
+    argparser = argparse.ArgumentParser(description='benchmark the command rejection path')
+    argparser.add_argument('--messages', type=int, default=20000)
+    args = argparser.parse_args()
+
+    messages = chat_messages(args.messages)
+    grammar = vebyastquotebot.commandparse.CommandGrammar(USER_ID, COMMANDS)
+
+    print('{:30} {:>15}'.format('rejection path', 'messages/s'))
+    print('{:30} {:15.0f}'.format('rebuilt per message', run(rebuilt_public_message_parse, messages)))
+    print('{:30} {:15.0f}'.format('precompiled + prefix check', run(grammar.public_message_parse, messages)))
+    print('{:30} {:15.0f}'.format('precompiled, no prefix check', run(
+        functools.partial(parse_or_none, grammar.mention),
+        messages,
+    )))
+
+if __name__ == '__main__':
+    main()
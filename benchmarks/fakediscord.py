@@ -0,0 +1,215 @@
+# an in-process stand-in for the parts of discord.Client (0.16) the bot uses,
+# for driving main.py without a connection. every call waits out a simulated
+# round trip, and calls are rate limited per endpoint and channel the way
+# discord does it; discord.py waits out 429s by itself, so here they just show
+# up as extra latency, counted in `throttled`.
+
+import asyncio
+import collections
+import datetime
+import itertools
+import random
+import discord
+
+import vebyastquotebot.logcache
+
+class FakeResponse(object):
+    def __init__(self, status, reason):
+        self.status = status
+        self.reason = reason
+
+def not_found(what):
+    return discord.NotFound(FakeResponse(404, 'Not Found'), what)
+
+class FakeColour(object):
+    def __init__(self, value):
+        self.value = value
+
+class FakeUser(object):
+    def __init__(self, id, name, discriminator='0001', colour=0):
+        self.id = id
+        self.name = name
+        self.display_name = name
+        self.discriminator = discriminator
+        self.colour = self.color = FakeColour(colour)
+
+    def __eq__(self, other):
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+class FakeServer(object):
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+class FakeChannel(object):
+    def __init__(self, id, name, server):
+        self.id = id
+        self.name = name
+        self.server = server
+        self.is_private = server is None
+        # oldest first
+        self.messages = []
+        self.by_id = {}
+
+class FakeMessage(object):
+    def __init__(self, id, channel, author, content, timestamp):
+        self.id = id
+        self.channel = channel
+        self.server = channel.server
+        self.author = author
+        self.content = content
+        self.timestamp = timestamp
+        self.edited_timestamp = None
+        self.attachments = []
+
+    @property
+    def clean_content(self):
+        return self.content
+
+class RateLimiter(object):
+    def __init__(self, rate, per, loop):
+        self.rate = rate
+        self.per = per
+        self.loop = loop
+        self.calls = collections.defaultdict(collections.deque)
+        self.throttled = collections.Counter()
+
+    async def wait(self, endpoint, bucket):
+        if not self.rate:
+            return
+        calls = self.calls[(endpoint, bucket)]
+        while True:
+            now = self.loop.time()
+            while calls and calls[0] <= now - self.per:
+                calls.popleft()
+            if len(calls) < self.rate:
+                calls.append(now)
+                return
+            self.throttled[endpoint] += 1
+            await asyncio.sleep(calls[0] + self.per - now)
+
+class FakeClient(object):
+    def __init__(self, *, latency=0.05, rate=5, per=5.0, seed=0, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.rng = random.Random(seed)
+        self.latency = latency
+        self.limiter = RateLimiter(rate, per, self.loop)
+        self.user = FakeUser('200000000000000001', 'quotebot', colour=0x336699)
+        self.users = {self.user.id: self.user}
+        self.channels = {}
+        self.calls = collections.Counter()
+        self.clock = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        self.sequence = itertools.count()
+        # called with every message that gets posted, the way the gateway
+        # would hand it to on_message
+        self.listener = None
+        self.edit_waiters = []
+
+    async def round_trip(self, endpoint, bucket):
+        self.calls[endpoint] += 1
+        await self.limiter.wait(endpoint, bucket)
+        await asyncio.sleep(self.rng.uniform(0.5, 1.5) * self.latency)
+
+    # setting up the fake world
+
+    def add_user(self, name):
+        user = FakeUser(str(100000000000000000 + len(self.users)), name, colour=self.rng.randrange(1 << 24))
+        self.users[user.id] = user
+        return user
+
+    def add_channel(self, name, server):
+        channel = FakeChannel(str(400000000000000000 + len(self.channels)), name, server)
+        self.channels[channel.id] = channel
+        return channel
+
+    def post(self, channel, author, content, when=None):
+        # ids have to sort like timestamps do, like real snowflakes
+        self.clock = max(self.clock + datetime.timedelta(milliseconds=1), when or datetime.datetime.utcnow())
+        message_id = str(vebyastquotebot.logcache.snowflake_from_datetime(self.clock) + next(self.sequence) % (1 << 22))
+        message = FakeMessage(message_id, channel, author, content, self.clock)
+        channel.messages.append(message)
+        channel.by_id[message.id] = message
+        return message
+
+    def remove(self, message):
+        channel = message.channel
+        if channel.by_id.pop(message.id, None) is None:
+            return False
+        channel.messages.remove(message)
+        return True
+
+    def wait_for_edit(self, message, predicate):
+        # resolves with the content of the first edit to `message` (or to any
+        # message, if that's None) that satisfies `predicate`
+        future = self.loop.create_future()
+        self.edit_waiters.append((message.id if message else None, predicate, future))
+        return future
+
+    # the discord.Client api
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    async def get_user_info(self, user_id):
+        await self.round_trip('get_user_info', None)
+        if user_id not in self.users:
+            raise not_found('Unknown User')
+        return self.users[user_id]
+
+    async def get_message(self, channel, message_id):
+        await self.round_trip('get_message', channel.id)
+        message = channel.by_id.get(str(message_id))
+        if message is None:
+            raise not_found('Unknown Message')
+        return message
+
+    async def send_message(self, channel, content):
+        await self.round_trip('send_message', channel.id)
+        message = self.post(channel, self.user, content)
+        if self.listener:
+            asyncio.ensure_future(self.listener(message))
+        return message
+
+    async def edit_message(self, message, content):
+        await self.round_trip('edit_message', message.channel.id)
+        message.content = content
+        message.edited_timestamp = datetime.datetime.utcnow()
+        for waiter in list(self.edit_waiters):
+            (message_id, predicate, future) = waiter
+            if message_id in (None, message.id) and predicate(content):
+                self.edit_waiters.remove(waiter)
+                if not future.done():
+                    future.set_result(content)
+        return message
+
+    async def delete_message(self, message):
+        await self.round_trip('delete_message', message.channel.id)
+        if not self.remove(message):
+            raise not_found('Unknown Message')
+
+    async def delete_messages(self, messages):
+        await self.round_trip('delete_messages', messages[0].channel.id)
+        for message in messages:
+            self.remove(message)
+
+    async def logs_from(self, channel, limit=100, *, before=None, after=None):
+        # newest first, except that with only `after` it pages forward from
+        # there, oldest first, like 0.16 does. pages are 100 messages, each
+        # its own round trip.
+        messages = channel.messages
+        if before is not None:
+            before_key = vebyastquotebot.logcache.sort_key(before)
+            messages = [m for m in messages if int(m.id) < before_key]
+        if after is not None:
+            after_key = vebyastquotebot.logcache.sort_key(after, high=True)
+            messages = [m for m in messages if int(m.id) > after_key]
+        if after is None or before is not None:
+            messages = messages[::-1]
+        messages = messages[:limit]
+        for i in range(0, len(messages), 100):
+            await self.round_trip('logs_from', channel.id)
+            for message in messages[i:i + 100]:
+                yield message
@@ -0,0 +1,104 @@
+#!python
+
+# fires a lot of concurrent /add- and /remove-shaped commands at one shared
+# quote store, each of which waits on a fake Discord round trip while its
+# QuoteDB is open, then reloads the store from disk and checks that every add
+# and every remove made it.
+#
+#     python benchmarks/stress_quotedb.py [--adds N] [--removes N] [--storage SNAPSHOT|JOURNAL|SQLITE]
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import vebyastquotebot.quotedb
+import vebyastquotebot.storage
+import synthetic
+
+class FakeClient(object):
+    # just enough of discord.Client for a command to wait on
+    def __init__(self, rng, latency):
+        self.rng = rng
+        self.latency = latency
+        self.edits = 0
+
+    async def edit_message(self, message, content):
+        await asyncio.sleep(self.rng.uniform(0, self.latency))
+        self.edits += 1
+        return message
+
+async def add(client, store, quote):
+    await client.edit_message(None, 'Processed logs. Saving and uploading...')
+    async with vebyastquotebot.quotedb.QuoteDB(
+            docommit=vebyastquotebot.quotedb.QuoteDBCommit.FS,
+            store=store,
+    ) as quote_db:
+        quote_db.add_quote(quote)
+        await client.edit_message(None, 'Saving...')
+    await client.edit_message(None, 'Done with /add!')
+
+async def remove(client, store, quote_id):
+    async with vebyastquotebot.quotedb.QuoteDB(
+            docommit=vebyastquotebot.quotedb.QuoteDBCommit.FS,
+            store=store,
+    ) as quote_db:
+        found = quote_db.remove_quote(quote_id)
+        # /remove reports progress from inside the block
+        await client.edit_message(None, 'Removed quotes. Uploading changes...')
+    await client.edit_message(None, 'Done with /remove!')
+    return found
+
+def main():
+    argparser = argparse.ArgumentParser(description='stress concurrent QuoteDB writers')
+    argparser.add_argument('--quotes', type=int, default=1000, help='size of the starting archive')
+    argparser.add_argument('--adds', type=int, default=500)
+    argparser.add_argument('--removes', type=int, default=500)
+    argparser.add_argument('--latency', type=float, default=0.05, help='max seconds per fake Discord call')
+    argparser.add_argument('--storage', default='SNAPSHOT',
+                           choices=[s.name for s in vebyastquotebot.quotedb.QuoteDBStorage])
+    argparser.add_argument('--seed', type=int, default=0)
+    args = argparser.parse_args()
+
+    rng = random.Random(args.seed)
+    initial = synthetic.make_quotes(args.quotes, seed=args.seed)
+    added = [dict(q, id='new-{}'.format(i)) for (i, q) in enumerate(synthetic.make_quotes(args.adds, seed=args.seed + 1))]
+    removed = rng.sample([q['id'] for q in initial], min(args.removes, len(initial)))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'quotes.json')
+        vebyastquotebot.storage.write_snapshot(filename, initial)
+        kind = vebyastquotebot.quotedb.QuoteDBStorage[args.storage]
+        store = vebyastquotebot.quotedb.QuoteStore(filename, vebyastquotebot.quotedb.make_storage(kind, filename))
+        store.refresh()
+
+        client = FakeClient(rng, args.latency)
+        commands = [add(client, store, q) for q in added] + [remove(client, store, i) for i in removed]
+        rng.shuffle(commands)
+
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        results = loop.run_until_complete(asyncio.gather(*commands))
+        elapsed = time.perf_counter() - start
+
+        # fold any journal back into the snapshot before reading it cold
+        store.compact()
+        reloaded = vebyastquotebot.quotedb.make_storage(kind, filename).load()
+        expected = set(q['id'] for q in initial) - set(removed) | set(q['id'] for q in added)
+
+        print('{} storage: {} commands in {:.2f}s, {} fake Discord calls'.format(
+            args.storage, len(commands), elapsed, client.edits))
+        print('removes reporting found: {}/{}'.format(sum(1 for r in results if r is True), len(removed)))
+        lost_adds = [q['id'] for q in added if q['id'] not in reloaded]
+        kept_removes = [i for i in removed if i in reloaded]
+        print('lost adds: {}, removes that came back: {}, quotes on disk: {} (expected {})'.format(
+            len(lost_adds), len(kept_removes), len(reloaded), len(expected)))
+        if lost_adds or kept_removes or set(reloaded) != expected:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+# synthetic quote archives shaped like what /add saves, for the benchmarks.
+
+import datetime
+import random
+
+WORDS = '''the quick brown fox jumps over lazy dog lol what did you mean by that
+i can't believe this actually happened again but honestly who is surprised
+'''.split()
+
+def make_line(rng, authors, when):
+    (name, author_id, color) = rng.choice(authors)
+    edited = when + datetime.timedelta(minutes=1) if rng.random() < 0.1 else None
+    return {
+        'author': name,
+        'author_id': author_id,
+        'timestamp': when.isoformat() + '+00:00',
+        'edited': edited.isoformat() + '+00:00' if edited else None,
+        'content': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 25))),
+        'authorcolor': color,
+        'attachments': [],
+    }
+
+def make_quotes(n, *, lines=8, nauthors=50, seed=0):
+    rng = random.Random(seed)
+    authors = [
+        ('user{}'.format(i), str(100000000000000000 + i), rng.choice([None, '#{:06X}'.format(rng.randrange(1 << 24))]))
+        for i in range(nauthors)
+    ]
+    channels = ['general', 'random', 'memes', 'serious-business']
+    start = datetime.datetime(2017, 1, 1)
+    quotes = []
+    for i in range(n):
+        when = start + datetime.timedelta(seconds=rng.randrange(60 * 60 * 24 * 365), microseconds=rng.randrange(1000000))
+        quotes.append({
+            'id': str(300000000000000000 + i),
+            'lines': [
+                make_line(rng, authors, when + datetime.timedelta(seconds=10 * j))
+                for j in range(rng.randint(1, 2 * lines))
+            ],
+            'quoted': (when + datetime.timedelta(hours=1)).isoformat(),
+            'server': 'Test Server',
+            'channel': rng.choice(channels),
+        })
+    return quotes
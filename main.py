@@ -3,19 +3,43 @@ import os
 import logging
 import logging.handlers
 from pythonjsonlogger import jsonlogger
-import pyparsing as ps
 import shlex
+import argparse
 import datetime
+import time
+import vebyastquotebot.commandparse
+import vebyastquotebot.deleting
+import vebyastquotebot.executors
+import vebyastquotebot.feedback
+import vebyastquotebot.gitwriter
 import vebyastquotebot.helpformatter
+import vebyastquotebot.logcache
+import vebyastquotebot.metrics
+import vebyastquotebot.monitor
+import vebyastquotebot.quotecodecs
 import vebyastquotebot.quotedb
+import vebyastquotebot.quoteservice
+import vebyastquotebot.quotesearch
+import vebyastquotebot.rendering
+import vebyastquotebot.sampling
 import vebyastquotebot.searching
 import vebyastquotebot.throwingargumentparser
 import io
+import signal
+import subprocess
+import functools
 import asyncio
 import sys
 import json
 
-LOG_FILENAME = 'vebyastquotebot.log'
+# with SHARD_COUNT > 1, the process that gets started is the writer: it owns
+# the quote database and git, and starts one worker per gateway shard (with
+# SHARD_ID set) that talk to it over QUOTE_SERVER_SOCKET
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', '1'))
+SHARD_ID = int(os.environ['SHARD_ID']) if 'SHARD_ID' in os.environ else None
+QUOTE_SERVER_SOCKET = os.environ.get('QUOTE_SERVER_SOCKET', 'quotes.sock')
+
+LOG_FILENAME = 'vebyastquotebot.log' if SHARD_ID is None else 'vebyastquotebot.shard{}.log'.format(SHARD_ID)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -41,53 +65,106 @@ logger.addHandler(rotating_handler)
 logger.addHandler(logging.StreamHandler())
 logging.info("Startup!")
 
+MONITOR = vebyastquotebot.monitor.MONITOR
+# discord.py reports its rate limit waits in its log
+MONITOR.install()
+
 DEFAULT_LIMIT = 1000
+# the longest quote /add will save, in lines
+QUOTE_MAX_LINES = int(os.environ.get('QUOTE_MAX_LINES', '5000'))
+# the shortest gap between progress edits to a command's feedback message
+FEEDBACK_INTERVAL = float(os.environ.get('FEEDBACK_INTERVAL', '1'))
+# the most messages /get and /random post for one long quote before asking for
+# the rest a page at a time
+QUOTE_MAX_PAGES = int(os.environ.get('QUOTE_MAX_PAGES', '5'))
+
+# worker threads for git and saving, and worker processes for the search index.
+# 0 threads keeps everything on the event loop.
+vebyastquotebot.executors.EXECUTORS.configure(
+    threads=int(os.environ.get('EXECUTOR_THREADS', '4')),
+    processes=int(os.environ.get('EXECUTOR_PROCESSES', '1')),
+)
 
 COMMANDS = {}
-def command(name):
+# commands that take arguments pass a `parser` function, which gets called
+# once here to build the command's argument parser. the registered handler
+# then takes care of parsing the argstring and hands the command its `args`.
+def command(name, parser=None):
     def fun(f):
+        if parser is not None:
+            f = with_parsed_args(f, parser())
         COMMANDS[name] = f
         return f
     return fun
 
-client = discord.Client()
+def with_parsed_args(f, parser):
+    @functools.wraps(f)
+    async def handler(*, message, feedback, argstring):
+        with METRICS.timer('parse', stage='arguments'):
+            (args, args_err) = await argstring_parse(argstring, parser)
+        if not args:
+            await feedback.finish(args_err)
+            return
+        await f(message=message, feedback=feedback, args=args)
+    return handler
+
+METRICS = vebyastquotebot.metrics.METRICS
+
+class QuoteBotClient(discord.Client):
+    # times the discord calls commands make to report progress and results
+    async def send_message(self, *args, **kwargs):
+        with METRICS.timer('discord', call='send_message'):
+            return await super().send_message(*args, **kwargs)
+
+    async def edit_message(self, *args, **kwargs):
+        with METRICS.timer('discord', call='edit_message'):
+            return await super().edit_message(*args, **kwargs)
+
+if SHARD_ID is not None:
+    client = QuoteBotClient(shard_id=SHARD_ID, shard_count=SHARD_COUNT)
+else:
+    client = QuoteBotClient()
+
+# built in on_ready, once we know our own user id
+GRAMMAR = None
 
 @client.event
 async def on_ready():
+    global GRAMMAR
+    GRAMMAR = vebyastquotebot.commandparse.CommandGrammar(client.user.id, COMMANDS.keys())
+    # on_ready also fires after a reconnect, and anything said while we were
+    # gone never reached the channel indexes
+    vebyastquotebot.searching.CHANNEL_INDEXES.mark_stale()
+    vebyastquotebot.logcache.HISTORY_CACHE.mark_stale()
     logging.info('Successfully logged in', extra = {'custom': {
         'username': client.user.name,
         'uid': client.user.id,
         'discriminator': client.user.discriminator,
     }})
 
+@client.event
+async def on_resumed():
+    vebyastquotebot.searching.CHANNEL_INDEXES.mark_stale()
+    vebyastquotebot.logcache.HISTORY_CACHE.mark_stale()
+
+@client.event
+async def on_message_edit(before, after):
+    vebyastquotebot.searching.CHANNEL_INDEXES.on_message_edit(after)
+    vebyastquotebot.logcache.HISTORY_CACHE.on_message_edit(after)
+
+@client.event
+async def on_message_delete(message):
+    vebyastquotebot.searching.CHANNEL_INDEXES.on_message_delete(message)
+    vebyastquotebot.logcache.HISTORY_CACHE.on_message_delete(message)
+
 def public_message_parse(command_line):
-    try:
-        parseresult = (
-            ('<@' + ps.Optional('!') + client.user.id + '>').setResultsName('user_id')
-            + ps.restOfLine.setResultsName('command_line')
-        ).parseString(command_line)
-        return (parseresult['command_line'], None)
-    except ps.ParseException as e:
-        return (None, e)
+    return GRAMMAR.public_message_parse(command_line)
 
 def command_line_parse(command_line):
-    try:
-        return ((
-            ps.Or(ps.CaselessKeyword(com) for com in COMMANDS.keys()).setResultsName('command') +
-            ps.restOfLine.setResultsName('argstring')
-        ).parseString(command_line), None)
-    except ps.ParseException as e:
-        return (None, e)
+    return GRAMMAR.command_line_parse(command_line)
 
 def channel_id_parse(arg):
-    try:
-        p = ps.Or((
-            ps.Word(ps.nums).setResultsName('channel_id'),
-            '<#' + ps.Word(ps.nums).setResultsName('channel_id') + '>',
-        ))
-        return (p.parseString(arg)['channel_id'], None)
-    except ps.ParseException as e:
-        return (None, e)
+    return vebyastquotebot.commandparse.channel_id_parse(arg)
 
 async def handle_channel_arg(arg):
     (channel_id, e) = channel_id_parse(arg)
@@ -98,14 +175,16 @@ async def handle_channel_arg(arg):
         return (None, "Channel not found")
     return (channel, None)
 
-async def argstring_parse(argstring, parser, parserio):
+async def argstring_parse(argstring, parser):
     try:
         lexed = shlex.split(argstring)
     except Exception as e:
         return (None, "Could not parse command string: {}".format(str(e)))
 
+    # the parser is shared between invocations, but its output isn't
+    parserio = io.StringIO()
     try:
-        args = parser.parse_args(args=lexed)
+        args = parser.parse_args_into(lexed, parserio)
     except (vebyastquotebot.throwingargumentparser.ArgumentParserError) as e:
         return (None, vebyastquotebot.quotedb.wrap_triple(str(e)))
     except (vebyastquotebot.throwingargumentparser.ArgumentParserExited) as e:
@@ -135,6 +214,27 @@ async def user_exists(user_id):
 def channel_exists(channel_id):
     return not not client.get_channel(channel_id)
 
+async def gather_or_cancel(*coros):
+    # like asyncio.gather, except that when one of them fails the others get
+    # cancelled instead of being left to run in the background
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+async def misclick_suggestion(message_id):
+    # checking the channel is free, so only go to discord about the user if
+    # that doesn't pan out
+    if channel_exists(message_id):
+        return "It's a valid channel ID, though; did you misclick?"
+    elif await user_exists(message_id):
+        return "It's a valid user ID, though; did you misclick?"
+    else:
+        return "Do you need a different `--channel`?"
+
 async def handle_message_arg(id_arg, query_arg, limit, channel):
     message = None
     err = None
@@ -143,12 +243,7 @@ async def handle_message_arg(id_arg, query_arg, limit, channel):
         try:
             message = await client.get_message(channel, message_id)
         except discord.errors.NotFound as e:
-            if await user_exists(message_id):
-                suggestion = "It's a valid user ID, though; did you misclick?"
-            elif channel_exists(message_id):
-                suggestion = "It's a valid channel ID, though; did you misclick?"
-            else:
-                suggestion = "Do you need a different `--channel`?"
+            suggestion = await misclick_suggestion(message_id)
 
             return (None, "Could not find message with ID {m_id}: {err}. {suggestion}".format(
                 m_id = message_id,
@@ -168,12 +263,47 @@ async def handle_message_arg(id_arg, query_arg, limit, channel):
         return (None, "Could not find message: {}".format(err))
     return (message, err)
 
+async def report_git_status(feedback, text, git_status):
+    # commits and pushes happen in the background; once ours has gone through
+    # (possibly batched with others), tack the outcome onto the feedback
+    if not git_status:
+        return
+    try:
+        status = await git_status
+    except Exception as e:
+        status = 'Committing failed: {}'.format(str(e))
+    await feedback.finish(text + '\n' + status)
+
+async def send_pages(message, feedback, pages, header):
+    # the first page goes in the feedback message and the next few follow it
+    # as messages of their own. header(pagenum) goes on top of each page.
+    for (pagenum, page) in enumerate(pages[:QUOTE_MAX_PAGES], start=1):
+        text = header(pagenum) + page
+        if pagenum == 1:
+            await feedback.finish(text)
+        else:
+            await client.send_message(message.channel, text)
+    if len(pages) > QUOTE_MAX_PAGES:
+        await client.send_message(message.channel, '{} more pages. Use `--page` to see them.'.format(
+            len(pages) - QUOTE_MAX_PAGES,
+        ))
+
 @client.event
 async def on_message(message):
+    # keep the search indexes and history cache current, including for our
+    # own posts, so that they cover the same window that pulling the logs would
+    vebyastquotebot.searching.CHANNEL_INDEXES.on_message(message)
+    vebyastquotebot.logcache.HISTORY_CACHE.on_message(message)
+
     # sorceror's apprentice protection, hopefully
     if message.author == client.user:
         return
 
+    if GRAMMAR is None:
+        # not logged in yet, so we don't know what a mention of us looks like
+        return
+
+    parse_start = time.perf_counter()
     command_line = message.content
     if message.server:
         (command_line, _) = public_message_parse(command_line)
@@ -183,13 +313,18 @@ async def on_message(message):
             return
 
     (parseresult, _) = command_line_parse(command_line)
+    METRICS.observe('parse', time.perf_counter() - parse_start, stage='command_line')
     if not parseresult:
         # feedback = await client.send_message(message.channel, 'No command recognized. Try `@{} /help`?'.format(
         #     client.user.display_name,
         # ))
         return
 
-    feedback = await client.send_message(message.channel, 'Received command {}. Processing...'.format(parseresult.command))
+    feedback = vebyastquotebot.feedback.FeedbackUpdater(
+        client,
+        await client.send_message(message.channel, 'Received command {}. Processing...'.format(parseresult.command)),
+        interval=FEEDBACK_INTERVAL,
+    )
 
     logging.info('handling command', extra = {'custom': {
         'command': parseresult.command,
@@ -198,10 +333,11 @@ async def on_message(message):
     }})
 
     try:
-        await COMMANDS[parseresult.command](
-            message=message,
-            argstring=parseresult.argstring,
-            feedback=feedback)
+        with METRICS.timer('command', command=parseresult.command), MONITOR.command(parseresult.command):
+            await COMMANDS[parseresult.command](
+                message=message,
+                argstring=parseresult.argstring,
+                feedback=feedback)
 
         logging.info('successfully handled command', extra = {'custom': {
             'command': parseresult.command,
@@ -209,7 +345,7 @@ async def on_message(message):
             'messageid': message.id,
         }})
     except Exception as e:
-        await client.edit_message(feedback, "Error executing {}".format(parseresult.command))
+        await feedback.finish("Error executing {}".format(parseresult.command))
         logging.error(e, extra = {'custom': {
             'command': parseresult.command,
             'argstring': parseresult.argstring,
@@ -217,14 +353,10 @@ async def on_message(message):
         }})
         raise e
 
-@command('/add')
-async def command_addquote(*, message, feedback, argstring):
-    parserio = io.StringIO()
-
+def add_parser():
     parser = vebyastquotebot.throwingargumentparser.ThrowingArgumentParser(
         prog='/add',
         description='add a quote.',
-        outfile=parserio,
         formatter_class=vebyastquotebot.helpformatter.QuotebotHelpFormatter,
     )
     start_group = parser.add_mutually_exclusive_group(required=True)
@@ -253,24 +385,26 @@ async def command_addquote(*, message, feedback, argstring):
     parser.add_argument('-n', '--noop',
                         action='store_true',
                         help="""Don't do the final upload. For testing purposes.""")
+    return parser
 
-    (args, args_err) = await argstring_parse(argstring, parser, parserio)
-    if not args:
-        await client.edit_message(feedback, args_err)
-        return
-
+@command('/add', parser=add_parser)
+async def command_addquote(*, message, feedback, args):
     if not args.channel:
         channel = message.channel
     else:
         (channel, channel_err) = await handle_channel_arg(args.channel)
         if not channel:
-            await client.edit_message(feedback, channel_err)
+            await feedback.finish(channel_err)
             return
 
     limit = DEFAULT_LIMIT
 
-    (start_message, start_err) = await handle_message_arg(args.start_id, args.start_query, limit, channel)
-    (end_message, end_err) = await handle_message_arg(args.end_id, args.end_query, limit, channel)
+    # the start and end lookups are independent round-trips, so do them both
+    # at once
+    ((start_message, start_err), (end_message, end_err)) = await gather_or_cancel(
+        handle_message_arg(args.start_id, args.start_query, limit, channel),
+        handle_message_arg(args.end_id, args.end_query, limit, channel),
+    )
 
     if not start_message or not end_message:
         errs = []
@@ -278,12 +412,12 @@ async def command_addquote(*, message, feedback, argstring):
             errs.append(start_err)
         if not end_message:
             errs.append(end_err)
-        await client.edit_message(feedback, '\n'.join(errs))
+        await feedback.finish('\n'.join(errs))
         return
 
     if start_message.channel != end_message.channel:
         # this should never happen. just in case, though...
-        await client.edit_message(feedback, 'Error in /add: Start and end messages must be from the same channel.')
+        await feedback.finish('Error in /add: Start and end messages must be from the same channel.')
         return
 
     start_block = vebyastquotebot.quotedb.format_message(start_message, short=30, wrap=True)
@@ -294,58 +428,62 @@ async def command_addquote(*, message, feedback, argstring):
     )
     quote_message = ' (quoting: ' + quote_block + ')'
 
-    await client.edit_message(feedback, "Processed command. Getting logs..." + quote_message)
-
-    logs = await vebyastquotebot.searching.pull_logs(
-        client=client,
-        start_message=start_message,
-        end_message=end_message,
-        limit=limit,
-    )
+    feedback.update("Processed command. Getting logs..." + quote_message)
 
-    if len(logs) == limit:
-        await client.edit_message(feedback, "Got exactly {limit} logs. If your quote is long it may have been truncated, so the add has been aborted. Specify a larger limit? See `--help`".format(
-            limit=limit,
+    # pages come newest first, and get converted while the next one is on its
+    # way
+    lines = []
+    try:
+        async for page in vebyastquotebot.searching.pull_logs(
+                client=client,
+                start_message=start_message,
+                end_message=end_message,
+                max_lines=QUOTE_MAX_LINES,
+        ):
+            lines.extend(vebyastquotebot.quotedb.message_to_json(log) for log in page)
+            feedback.update("Got {nlines} logs so far...".format(nlines=len(lines)) + quote_message)
+    except vebyastquotebot.searching.QuoteTooLong as e:
+        await feedback.finish("Whoa, that's a big quote. Too big, in fact: {err}. :/ Talk to the bot's owner for help getting that many logs.".format(
+            err=str(e),
         ))
         return
-    # if len(logs) == DEFAULT_LIMIT:
-    #     await client.edit_message(feedback, "Whoa, that's a big quote. Too big, in fact. :/ Talk to the bot's owner for help getting that many logs.")
-    #     return
+    lines.reverse()
 
-    await client.edit_message(feedback, "Got logs. Processing logs..." + quote_message)
+    feedback.update("Got logs. Processing logs..." + quote_message)
 
     json_obj = {
         'id': str(message.id),  # reuse the id of the command message, but
                                 # tostring because javascript is shit
-        'lines': [vebyastquotebot.quotedb.message_to_json(log) for log in logs],
+        'lines': lines,
         'quoted': datetime.datetime.utcnow().isoformat(),
         'server': channel.server.name if channel.server else 'Private Messages',
         'channel': channel.name or 'Private Messages',
     }
 
-    await client.edit_message(feedback, "Processed logs. Saving and uploading..." + quote_message)
+    feedback.update("Processed logs. Saving and uploading..." + quote_message)
 
     if not args.noop:
-        with vebyastquotebot.quotedb.QuoteDB(
-                docommit=vebyastquotebot.quotedb.QuoteDBCommit[os.environ['QUOTE_DB_COMMIT']],
-                commit_message='/add (by {}#{})'.format(message.author.name, message.author.discriminator),
-        ) as quote:
-            quote.add_quote(json_obj)
+        git_status = await QUOTES.add(
+            json_obj,
+            commit_message='/add (by {}#{})'.format(message.author.name, message.author.discriminator),
+        )
 
-        await client.edit_message(feedback, "Done with /add! Quoted {result} ({nlines} lines).\nResult (maybe after a wait): <{url}>".format(
+        done_text = "Done with /add! Quoted {result} ({nlines} lines).\nResult (maybe after a wait): <{url}>".format(
             nlines=len(json_obj['lines']),
             quote_id=json_obj['id'],
             result=quote_block,
             url=os.environ['USER_INTERFACE_URL'] + '#/quote_id/' + str(json_obj['id']),
-        ))
+        )
+        await feedback.finish(done_text)
         logging.info('adding quote', extra = {'custom': {
             'num_lines': len(json_obj['lines']),
             'quote_id': json_obj['id'],
             'quote_block': quote_block,
             'quote_url': os.environ['USER_INTERFACE_URL'] + '#/quote_id/' + str(json_obj['id']),
         }})
+        await report_git_status(feedback, done_text, git_status)
     else:
-        await client.edit_message(feedback, "NOOP passed, but /add would have been Done: {result} ({nlines} lines).".format(
+        await feedback.finish("NOOP passed, but /add would have been Done: {result} ({nlines} lines).".format(
             nlines=len(json_obj['lines']),
             result=quote_block,
         ))
@@ -356,80 +494,77 @@ async def command_addquote(*, message, feedback, argstring):
             'quote_url': os.environ['USER_INTERFACE_URL'] + '#/quote_id/' + str(json_obj['id']),
         }})
 
-@command('/remove')
-async def remove_quote(*, message, feedback, argstring):
-    parserio = io.StringIO()
+def remove_parser():
     parser = vebyastquotebot.throwingargumentparser.ThrowingArgumentParser(
         prog='/remove',
         description='remove a quote.',
-        outfile=parserio,
         formatter_class=vebyastquotebot.helpformatter.QuotebotHelpFormatter,
     )
     parser.add_argument('quote_id',
                         type=str,
-                        action='append',
+                        nargs='+',
                         help='ID of a quote to be deleted. Can be given multiple times.')
-    (args, args_err) = await argstring_parse(argstring, parser, parserio)
-    if not args:
-        await client.edit_message(feedback, args_err)
-        return
+    return parser
 
-    await client.edit_message(feedback, "Processed command. Removing quote...")
-
-    with vebyastquotebot.quotedb.QuoteDB(
-            docommit=vebyastquotebot.quotedb.QuoteDBCommit[os.environ['QUOTE_DB_COMMIT']],
-            commit_message='/remove (by {}#{})'.format(message.author.name, message.author.discriminator),
-    ) as quote:
-        before = len(quote.quotes)
-        for quote_id in args.quote_id:
-            quote.remove_quote(quote_id)
-        after = len(quote.quotes)
-        await client.edit_message(feedback, "Removed {nremoved} quotes. Uploading changes...".format(
-            nremoved = before - after,
-        ))
+@command('/remove', parser=remove_parser)
+async def remove_quote(*, message, feedback, args):
+    feedback.update("Processed command. Removing quote...")
 
-    await client.edit_message(feedback, "Done with /remove! Removed {nremoved} quotes.".format(
-        nremoved = before - after,
-    ))
+    (results, git_status) = await QUOTES.remove(
+        args.quote_id,
+        commit_message='/remove (by {}#{})'.format(message.author.name, message.author.discriminator),
+    )
+    nremoved = sum(1 for found in results.values() if found)
 
-@command('/get')
-async def get_quote(*, message, feedback, argstring):
-    parserio = io.StringIO()
+    missing = [quote_id for (quote_id, found) in results.items() if not found]
+    done_text = "Done with /remove! Removed {nremoved} quotes.".format(
+        nremoved = nremoved,
+    )
+    if missing:
+        done_text += " Could not find: {}".format(', '.join(missing))
+    await feedback.finish(done_text)
+    await report_git_status(feedback, done_text, git_status)
+
+def get_parser():
     parser = vebyastquotebot.throwingargumentparser.ThrowingArgumentParser(
         prog='/get',
         description='get a quote.',
-        outfile=parserio,
         formatter_class=vebyastquotebot.helpformatter.QuotebotHelpFormatter,
     )
     parser.add_argument('quote_id',
                         type=str,
                         help='The ID of the quote to be quoted.')
-    (args, args_err) = await argstring_parse(argstring, parser, parserio)
-    if not args:
-        await client.edit_message(feedback, args_err)
+    parser.add_argument('-p', '--page',
+                        type=int,
+                        help='''Only show this page of a quote too long for one message.''')
+    return parser
+
+@command('/get', parser=get_parser)
+async def get_quote(*, message, feedback, args):
+    feedback.update("Processed command. Getting quote...")
+
+    pages = await QUOTES.render(args.quote_id)
+    if pages is None:
+        await feedback.finish("Could not find quote with ID {quoteid}.".format(
+            quoteid = args.quote_id,
+        ))
         return
 
-    await client.edit_message(feedback, "Processed command. Getting quote...")
-
-    with vebyastquotebot.quotedb.QuoteDB(
-            docommit=vebyastquotebot.quotedb.QuoteDBCommit.READONLY,
-    ) as quote:
-        if args.quote_id not in quote.index:
-            await client.edit_message(feedback, "Could not find quote with ID {quoteid}.".format(
-                quoteid = args.quote_id,
-            ))
-        else:
-            q = quote.index[args.quote_id]
-            await client.edit_message(feedback, vebyastquotebot.quotedb.format_quote(q))
+    if args.page is None:
+        await send_pages(message, feedback, pages,
+                         lambda pagenum: 'Page {}/{}:\n'.format(pagenum, len(pages)) if len(pages) > 1 else '')
+    elif 1 <= args.page <= len(pages):
+        await feedback.finish('Page {}/{}:\n{}'.format(args.page, len(pages), pages[args.page - 1]))
+    else:
+        await feedback.finish("Quote {quoteid} only has {pagecount} page(s).".format(
+            quoteid = args.quote_id,
+            pagecount = len(pages),
+        ))
 
-@command('/clear')
-@command('/clean')
-async def clean(*, message, feedback, argstring):
-    parserio = io.StringIO()
+def clean_parser():
     parser = vebyastquotebot.throwingargumentparser.ThrowingArgumentParser(
         prog='/clean',
         description='''Cleans up this bot's outputs.''',
-        outfile=parserio,
         formatter_class=vebyastquotebot.helpformatter.QuotebotHelpFormatter,
     )
     volume_group = parser.add_mutually_exclusive_group(required=True)
@@ -443,21 +578,129 @@ async def clean(*, message, feedback, argstring):
     parser.add_argument('-c', '--channel',
                         type=str,
                         help='Channel to clean up.')
+    return parser
+
+def search_parser():
+    parser = vebyastquotebot.throwingargumentparser.ThrowingArgumentParser(
+        prog='/search',
+        description='search the saved quotes.',
+        formatter_class=vebyastquotebot.helpformatter.QuotebotHelpFormatter,
+    )
+    parser.add_argument('query',
+                        type=str,
+                        nargs='+',
+                        help='''Words to look for. Matches quote text, authors, server and channel. Fields can be searched directly, e.g. 'author:vebyast channel:general'.''')
+    parser.add_argument('-p', '--page',
+                        type=int,
+                        default=1,
+                        help='Which page of results to show.')
+    return parser
+
+@command('/search', parser=search_parser)
+async def search_quotes(*, message, feedback, args):
+    if args.page < 1:
+        await feedback.finish("Pages start at 1.")
+        return
+
+    page = await QUOTES.search(' '.join(args.query), pagenum=args.page)
+    if not page.total:
+        await feedback.finish("No quotes matching query.")
+        return
+    if args.page > page.pagecount:
+        # the index would quietly hand back the last page instead
+        await feedback.finish("There are only {} page(s) of results.".format(page.pagecount))
+        return
+
+    await feedback.finish('\n'.join(
+        ['Found {total} quotes (page {pagenum} of {pagecount}):'.format(
+            total=page.total,
+            pagenum=page.pagenum,
+            pagecount=page.pagecount,
+        )] + [
+            '`{quote_id}` {preview}'.format(**result)
+            for result in page.results
+        ]
+    ))
+
+def date_arg(s):
+    try:
+        return datetime.datetime.strptime(s, '%Y-%m-%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError('dates look like 2017-06-30, not {}'.format(s))
+
+def random_parser():
+    parser = vebyastquotebot.throwingargumentparser.ThrowingArgumentParser(
+        prog='/random',
+        description='get a random quote.',
+        formatter_class=vebyastquotebot.helpformatter.QuotebotHelpFormatter,
+    )
+    parser.add_argument('-a', '--author',
+                        type=str,
+                        help='Only quotes that this user speaks in. A mention or a user ID.')
+    parser.add_argument('-c', '--channel',
+                        type=str,
+                        help='Only quotes from this channel. A clickable channel link or a channel name.')
+    parser.add_argument('-s', '--server',
+                        type=str,
+                        help='Only quotes from the server with this name.')
+    parser.add_argument('--since',
+                        type=date_arg,
+                        help='Only quotes saved on or after this date, e.g. 2017-06-30.')
+    parser.add_argument('--until',
+                        type=date_arg,
+                        help='Only quotes saved on or before this date, e.g. 2017-06-30.')
+    return parser
+
+@command('/random', parser=random_parser)
+async def random_quote(*, message, feedback, args):
+    author_id = None
+    if args.author:
+        (author_id, e) = vebyastquotebot.commandparse.user_id_parse(args.author)
+        if not author_id:
+            await feedback.finish("Error reading author: {}".format(str(e)))
+            return
 
-    (args, args_err) = await argstring_parse(argstring, parser, parserio)
-    if not args:
-        await client.edit_message(feedback, args_err)
+    channel_name = None
+    if args.channel:
+        (channel_id, _) = channel_id_parse(args.channel)
+        channel = client.get_channel(channel_id) if channel_id else None
+        # quotes only remember the channel's name
+        channel_name = channel.name if channel else args.channel
+
+    # the quoted timestamps are naive utc isoformat strings, which compare
+    # correctly as strings
+    since = args.since.isoformat() if args.since else None
+    until = (args.until + datetime.timedelta(days=1)).isoformat() if args.until else None
+
+    (quote_id, _) = await QUOTES.sample(
+        author_id=author_id,
+        channel=channel_name,
+        server=args.server,
+        since=since,
+        until=until,
+    )
+    pages = await QUOTES.render(quote_id) if quote_id is not None else None
+    if pages is None:
+        await feedback.finish("No quotes match that.")
         return
 
+    await send_pages(message, feedback, pages, lambda pagenum: 'Quote `{quote_id}`{page}:\n'.format(
+        quote_id=quote_id,
+        page=' (page {}/{})'.format(pagenum, len(pages)) if len(pages) > 1 else '',
+    ))
+
+@command('/clear')
+@command('/clean', parser=clean_parser)
+async def clean(*, message, feedback, args):
     if not args.channel:
         channel = message.channel
     else:
         (channel, err) = await handle_channel_arg(args.channel)
         if not channel:
-            await client.edit_message(feedback, err)
+            await feedback.finish(err)
             return
 
-    await client.edit_message(feedback, "Processed command. Deleting posts ...")
+    feedback.update("Processed command. Deleting posts ...")
 
     if args.minutes:
         log_args = {
@@ -469,27 +712,44 @@ async def clean(*, message, feedback, argstring):
             'limit': min(args.count, DEFAULT_LIMIT),
         }
 
-    ndeletes = 0
-    async for log in client.logs_from(
-            channel=channel,
-            **log_args
-    ):
-        if log.author == client.user and log.id != feedback.id:
-            ndeletes += 1
-            await client.delete_message(log)
-
-    await client.edit_message(feedback, "Deleted {ndeletes} posts.".format(
-        ndeletes=ndeletes,
+    logs = await vebyastquotebot.logcache.HISTORY_CACHE.logs_from(
+        client,
+        channel,
+        **log_args
+    )
+    candidates = [log for log in logs if log.author == client.user and log.id != feedback.id]
+
+    # progress edits share the channel's rate limit with the deletes, so
+    # space them out more than usual
+    feedback.interval = max(feedback.interval, 2)
+    async def progress(ndeleted):
+        feedback.update("Deleting posts ... {ndeleted}/{total}".format(
+            ndeleted=ndeleted,
+            total=len(candidates),
+        ))
+
+    deleted = await vebyastquotebot.deleting.delete_messages(client, candidates, progress)
+    for log in deleted:
+        vebyastquotebot.logcache.HISTORY_CACHE.on_message_delete(log)
+
+    await feedback.finish("Deleted {ndeletes} posts.".format(
+        ndeletes=len(deleted),
     ))
     await asyncio.sleep(15)
-    await client.delete_message(feedback)
+    await feedback.delete()
+
+@command('/stats')
+async def print_stats(*, message, feedback, argstring):
+    text = vebyastquotebot.monitor.format_stats(MONITOR.summary())
+    if SHARD_ID is not None:
+        text = 'Shard {}/{}\n'.format(SHARD_ID, SHARD_COUNT) + text
+    await feedback.finish('```' + text + '```')
 
 @command('/help')
 @command('help')
 @command('--help')
 async def print_help(*, message, feedback, argstring):
-    await client.edit_message(
-        feedback,
+    await feedback.finish(
         '\n'.join([
             '```usage: @{} /command [arguments]'.format(client.user.display_name),
             '',
@@ -500,7 +760,10 @@ async def print_help(*, message, feedback, argstring):
             '  {command:15} {help}'.format(command='/add', help='''Add a quote to the database'''),
             '  {command:15} {help}'.format(command='/remove', help='''Remove a quote from the database'''),
             '  {command:15} {help}'.format(command='/get', help='''Print out a quote from the database'''),
+            '  {command:15} {help}'.format(command='/search', help='''Search the quote database'''),
+            '  {command:15} {help}'.format(command='/random', help='''Print out a random quote'''),
             '  {command:15} {help}'.format(command='/clean', help='''Clean up this bot's output'''),
+            '  {command:15} {help}'.format(command='/stats', help='''Print how the bot is doing'''),
             '  {command:15} {help}'.format(command='/help', help='''Output this message'''),
             '',
             'Issue "@{} /command --help" for help with each individual command.'.format(client.user.display_name),
@@ -524,4 +787,157 @@ if 'USER_INTERFACE_URL' not in os.environ:
     logging.error('Need to set the USER_INTERFACE_URL environment variable', file=sys.stderr)
     sys.exit(1)
 
-client.run(os.environ['DISCORD_BOT_TOKEN'])
+if os.environ.get('QUOTE_DB_STORAGE', 'SNAPSHOT') not in vebyastquotebot.quotedb.QuoteDBStorage.__members__:
+    logging.error("QUOTE_DB_STORAGE must be one of the following values: {}".format(
+        ', '.join(en.name for en in vebyastquotebot.quotedb.QuoteDBStorage)
+    ))
+    sys.exit(1)
+
+QUOTE_DB_STORAGE = vebyastquotebot.quotedb.QuoteDBStorage[os.environ.get('QUOTE_DB_STORAGE', 'SNAPSHOT')]
+storage_kwargs = {}
+if QUOTE_DB_STORAGE == vebyastquotebot.quotedb.QuoteDBStorage.JOURNAL and 'QUOTE_DB_COMPACT_EVERY' in os.environ:
+    storage_kwargs['compact_every'] = int(os.environ['QUOTE_DB_COMPACT_EVERY'])
+if 'QUOTE_DB_CODEC' in os.environ:
+    try:
+        storage_kwargs['codec'] = vebyastquotebot.quotecodecs.get_codec(os.environ['QUOTE_DB_CODEC'])
+    except ValueError as e:
+        logging.error("QUOTE_DB_CODEC: {}".format(str(e)))
+        sys.exit(1)
+if QUOTE_DB_STORAGE == vebyastquotebot.quotedb.QuoteDBStorage.SQLITE and ('QUOTE_DB_CODEC' in os.environ or os.environ.get('QUOTE_DB_LAZY')):
+    logging.error("QUOTE_DB_CODEC and QUOTE_DB_LAZY don't apply to QUOTE_DB_STORAGE=SQLITE")
+    sys.exit(1)
+if QUOTE_DB_STORAGE == vebyastquotebot.quotedb.QuoteDBStorage.SQLITE and 'QUOTE_DB_SQLITE_FILE' in os.environ:
+    storage_kwargs['db_filename'] = os.environ['QUOTE_DB_SQLITE_FILE']
+if os.environ.get('QUOTE_DB_LAZY'):
+    # keep only byte offsets in memory and decode quotes as they're needed
+    storage_kwargs['lazy'] = True
+
+if SHARD_ID is not None:
+    # a shard: the writer process has the quotes
+    QUOTES = vebyastquotebot.quoteservice.RemoteQuotes(QUOTE_SERVER_SOCKET)
+else:
+    # load the quote database once up front; every command after this reuses
+    # the same in-memory copy
+    QUOTE_STORE = vebyastquotebot.quotedb.shared_store(storage=QUOTE_DB_STORAGE, **storage_kwargs)
+
+    QUOTE_INDEX = vebyastquotebot.quotesearch.QuoteIndex(
+        os.environ.get('QUOTE_INDEX_DIR', vebyastquotebot.quotesearch.QUOTE_INDEX_DIRNAME),
+    )
+    QUOTE_STORE.add_listener(QUOTE_INDEX)
+    QUOTE_SAMPLER = vebyastquotebot.sampling.QuoteSampler()
+    QUOTE_STORE.add_listener(QUOTE_SAMPLER)
+    QUOTE_RENDERS = vebyastquotebot.rendering.RenderCache()
+    QUOTE_STORE.add_listener(QUOTE_RENDERS)
+
+    QUOTE_STORE.refresh()
+
+    GIT_WRITER = vebyastquotebot.gitwriter.GitWriter(
+        QUOTE_STORE,
+        delay=float(os.environ.get('QUOTE_DB_COMMIT_DELAY', '5')),
+        loop=client.loop,
+    )
+
+    QUOTES = vebyastquotebot.quoteservice.LocalQuotes(
+        store=QUOTE_STORE,
+        index=QUOTE_INDEX,
+        sampler=QUOTE_SAMPLER,
+        renders=QUOTE_RENDERS,
+        gitwriter=GIT_WRITER,
+        docommit=vebyastquotebot.quotedb.QuoteDBCommit[os.environ['QUOTE_DB_COMMIT']],
+    )
+
+def start_shard(shard_id):
+    return subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__)],
+        env=dict(os.environ, SHARD_ID=str(shard_id)),
+    )
+
+async def supervise_shards(shards):
+    # a shard that dies gets started again; the writer stays up throughout
+    while True:
+        await asyncio.sleep(5)
+        for (shard_id, shard) in enumerate(shards):
+            if shard.poll() is not None:
+                logging.warning('shard exited, restarting it', extra = {'custom': {
+                    'shard_id': shard_id,
+                    'returncode': shard.returncode,
+                }})
+                shards[shard_id] = start_shard(shard_id)
+
+def stop_shards(shards, timeout=10):
+    for shard in shards:
+        if shard.poll() is None:
+            shard.terminate()
+    for shard in shards:
+        try:
+            shard.wait(timeout)
+        except subprocess.TimeoutExpired:
+            shard.kill()
+            shard.wait()
+
+def close_git_writer(loop):
+    # only the process that has the quotes commits them
+    if SHARD_ID is None:
+        loop.run_until_complete(GIT_WRITER.close())
+
+def run_client():
+    # like client.run, but a signal also stops the bot cleanly instead of
+    # killing it with changes still waiting to be committed
+    loop = client.loop
+    main = loop.create_task(client.start(os.environ['DISCORD_BOT_TOKEN']))
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, main.cancel)
+    try:
+        loop.run_until_complete(main)
+    except asyncio.CancelledError:
+        logging.info('bot stopping')
+    finally:
+        loop.run_until_complete(client.logout())
+        close_git_writer(loop)
+        loop.close()
+
+def run_writer():
+    loop = client.loop
+    loop.run_until_complete(vebyastquotebot.quoteservice.QuoteServer(QUOTES).serve(QUOTE_SERVER_SOCKET))
+    shards = [start_shard(shard_id) for shard_id in range(SHARD_COUNT)]
+    supervisor = loop.create_task(supervise_shards(shards))
+    # systemd and docker stop the writer with a signal, which would otherwise
+    # kill it outright and leave the shards connected to the gateway with no
+    # writer to talk to; stop supervising and take them down first
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, supervisor.cancel)
+    try:
+        loop.run_until_complete(supervisor)
+    except asyncio.CancelledError:
+        logging.info('writer stopping', extra = {'custom': {
+            'num_shards': len(shards),
+        }})
+    finally:
+        stop_shards(shards)
+        # after the shards, which can still be sending changes until they stop
+        close_git_writer(loop)
+
+# everything above can be imported without connecting to discord (which is
+# what benchmarks/bench_commands.py does); only actually running connects
+if __name__ == '__main__':
+    # phase timings go to the log every METRICS_LOG_INTERVAL seconds, and are
+    # served as prometheus text on 127.0.0.1:METRICS_PORT if that's set (each
+    # shard takes the next port up from the writer's)
+    client.loop.create_task(METRICS.report_every(float(os.environ.get('METRICS_LOG_INTERVAL', '300'))))
+    # loop lag is sampled every MONITOR_LAG_INTERVAL seconds, and the monitor's
+    # numbers go to the log every MONITOR_LOG_INTERVAL seconds
+    MONITOR.run(
+        lag_interval=float(os.environ.get('MONITOR_LAG_INTERVAL', '0.1')),
+        report_interval=float(os.environ.get('MONITOR_LOG_INTERVAL', '300')),
+        loop=client.loop,
+    )
+    if 'METRICS_PORT' in os.environ:
+        client.loop.run_until_complete(METRICS.serve(
+            host=os.environ.get('METRICS_HOST', '127.0.0.1'),
+            port=int(os.environ['METRICS_PORT']) + (0 if SHARD_ID is None else SHARD_ID + 1),
+        ))
+
+    if SHARD_COUNT > 1 and SHARD_ID is None:
+        run_writer()
+    else:
+        run_client()
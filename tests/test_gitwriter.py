@@ -0,0 +1,46 @@
+import asyncio
+import unittest
+
+import vebyastquotebot.gitwriter
+
+class FakeStore(object):
+    async def prepare_commit_async(self):
+        return ['quotes.json']
+
+class RecordingGitWriter(vebyastquotebot.gitwriter.GitWriter):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.commits = []
+
+    def commit(self, files, message):
+        self.commits.append((files, message))
+
+class GitWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_close_flushes_pending(self):
+        writer = RecordingGitWriter(FakeStore(), delay=3600, loop=self.loop)
+        async def go():
+            first = writer.submit('add quote 1')
+            second = writer.submit('add quote 2')
+            # let run() start waiting
+            await asyncio.sleep(0)
+            await asyncio.wait_for(writer.close(), 5)
+            return (first.result(), second.result())
+        statuses = self.loop.run_until_complete(go())
+        self.assertEqual(statuses, ('Committed 2 change(s).',) * 2)
+        self.assertEqual(writer.commits, [(['quotes.json'], '2 changes\n\nadd quote 1\nadd quote 2')])
+
+    def test_close_idle(self):
+        writer = RecordingGitWriter(FakeStore(), delay=3600, loop=self.loop)
+        self.loop.run_until_complete(writer.close())
+        self.assertEqual(writer.commits, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import asyncio
+import unittest
+
+import vebyastquotebot.logcache
+
+class FakeMessage(object):
+    def __init__(self, message_id):
+        self.id = str(message_id)
+
+class FakeChannel(object):
+    id = '1'
+
+class FakeClient(object):
+    # a channel with messages 1..`num_messages`, newest first like discord
+    def __init__(self, num_messages):
+        self.num_messages = num_messages
+        self.requests = []
+
+    async def logs_from(self, channel, limit=100, before=None, after=None):
+        self.requests.append((limit, before and before.id, after and after.id))
+        newest = self.num_messages if before is None else int(before.id) - 1
+        oldest = 1 if after is None else int(after.id) + 1
+        for i in range(newest, max(oldest, newest - limit + 1) - 1, -1):
+            yield FakeMessage(i)
+
+class ChannelHistoryTest(unittest.TestCase):
+    def test_prepend_overlapping_appends(self):
+        # the gateway delivered 5 and 6 while the first fetch, which also
+        # returned them, was in flight
+        history = vebyastquotebot.logcache.ChannelHistory(channel=None)
+        history.append(FakeMessage(5))
+        history.append(FakeMessage(6))
+        history.prepend([FakeMessage(i) for i in [6, 5, 4, 3]])
+        self.assertEqual(history.ids, [3, 4, 5, 6])
+        self.assertEqual([m.id for m in history.between(None, None)], ['3', '4', '5', '6'])
+
+    def test_prepend(self):
+        history = vebyastquotebot.logcache.ChannelHistory(channel=None)
+        history.prepend([FakeMessage(i) for i in [8, 7]])
+        history.prepend([FakeMessage(i) for i in [6, 5]])
+        self.assertEqual(history.ids, [5, 6, 7, 8])
+
+class HistoryCacheTest(unittest.TestCase):
+    def logs_from(self, cache, client, **kwargs):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(cache.logs_from(client, FakeChannel(), **kwargs))
+        finally:
+            loop.close()
+
+    def test_range_older_than_cache(self):
+        cache = vebyastquotebot.logcache.HistoryCache()
+        client = FakeClient(10000)
+        logs = self.logs_from(cache, client, limit=10)
+        self.assertEqual([m.id for m in logs], [str(i) for i in range(10000, 9990, -1)])
+
+        logs = self.logs_from(cache, client, limit=5, before=FakeMessage(51))
+        self.assertEqual([m.id for m in logs], ['50', '49', '48', '47', '46'])
+        # one request for the range itself, not one per page in between
+        self.assertEqual(client.requests[1:], [(5, '51', None)])
+        self.assertEqual(len(cache.histories['1']), 100)
+
+    def test_extends_cache(self):
+        cache = vebyastquotebot.logcache.HistoryCache()
+        client = FakeClient(1000)
+        self.logs_from(cache, client, limit=10)
+        logs = self.logs_from(cache, client, limit=150, before=FakeMessage(950))
+        self.assertEqual(logs[0].id, '949')
+        self.assertEqual(logs[-1].id, '800')
+        self.assertEqual(cache.histories['1'].ids[0], 800)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import logging
+import unittest
+
+import vebyastquotebot.metrics
+import vebyastquotebot.monitor
+
+# the messages discord.py 0.16 logs from discord/http.py, formatted the same way
+RATE_LIMITED = 'We are being rate limited. Retrying in {:.2} seconds. Handled under the bucket "{}"'
+GLOBAL_RATE_LIMITED = 'Global rate limit has been hit. Retrying in {:.2} seconds.'
+BUCKET_EXHAUSTED = 'A rate limit bucket has been exhausted (bucket: {bucket}, retry: {delta}).'
+
+class RateLimitHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.monitor = vebyastquotebot.monitor.Monitor(metrics=vebyastquotebot.metrics.Metrics())
+        self.handler = vebyastquotebot.monitor.RateLimitHandler(self.monitor)
+        self.logger = logging.getLogger('test_monitor.discord.http')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def limits(self):
+        return {
+            endpoint: (limits.count, limits.wait)
+            for (endpoint, limits) in self.monitor.rate_limits.items()
+        }
+
+    def test_rate_limited(self):
+        path = '/channels/{channel_id}/messages/{message_id}'
+        self.logger.info(RATE_LIMITED.format(1.5, 'PATCH:111:222:' + path))
+        self.logger.info(RATE_LIMITED.format(0.25, 'PATCH:333:444:' + path))
+        self.assertEqual(self.limits(), {'PATCH ' + path: (2, 1.75)})
+
+    def test_long_waits(self):
+        # '{:.2}' puts anything of 10 seconds or more in exponent notation
+        self.logger.info(RATE_LIMITED.format(12.0, 'DELETE:111:None:/channels/{channel_id}/messages/{message_id}'))
+        self.logger.info(GLOBAL_RATE_LIMITED.format(15.0))
+        self.assertEqual(self.limits(), {
+            'DELETE /channels/{channel_id}/messages/{message_id}': (1, 12.0),
+            'global': (1, 15.0),
+        })
+
+    def test_bucket_exhausted(self):
+        self.logger.info(BUCKET_EXHAUSTED.format(bucket='GET:111:222:/channels/{channel_id}/messages', delta=0.8))
+        self.assertEqual(self.limits(), {'GET /channels/{channel_id}/messages': (1, 0.8)})
+
+    def test_other_messages(self):
+        self.logger.info('GET https://discordapp.com/api/v6/gateway has returned 200')
+        self.assertEqual(self.limits(), {})
+
+if __name__ == '__main__':
+    unittest.main()
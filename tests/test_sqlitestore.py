@@ -0,0 +1,65 @@
+import json
+import os
+import tempfile
+import unittest
+
+import vebyastquotebot.sqlitestore
+
+def make_quote():
+    return {
+        'id': '1',
+        'lines': [{
+            'author': 'someone',
+            'author_id': '2',
+            'timestamp': '2017-01-01T00:00:00+00:00',
+            'edited': None,
+            'content': 'hello',
+            'authorcolor': None,
+            'attachments': [],
+        }],
+        'quoted': '2017-01-01T01:00:00',
+        'server': 'server',
+        'channel': 'general',
+    }
+
+class SeedTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'quotes.json')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_quotes(self, quotes):
+        with open(self.filename, 'w') as jsf:
+            json.dump(quotes, jsf)
+
+    def test_seed_from_empty_array(self):
+        self.write_quotes([])
+        storage = vebyastquotebot.sqlitestore.SQLiteStorage(self.filename)
+        self.assertEqual(len(storage.load()), 0)
+        self.assertFalse(storage.conn.in_transaction)
+        self.assertEqual(len(storage.load()), 0)
+
+    def test_no_reseed_after_removing_everything(self):
+        self.write_quotes([make_quote()])
+        storage = vebyastquotebot.sqlitestore.SQLiteStorage(self.filename)
+        index = storage.load()
+        del index['1']
+        storage.save(index, [])
+        # quotes.json is only exported at commit time, so it still has the
+        # removed quote in it
+        reopened = vebyastquotebot.sqlitestore.SQLiteStorage(self.filename)
+        self.assertEqual(len(reopened.load()), 0)
+
+    def test_seed(self):
+        quote = make_quote()
+        self.write_quotes([quote])
+        storage = vebyastquotebot.sqlitestore.SQLiteStorage(self.filename)
+        index = storage.load()
+        self.assertFalse(storage.conn.in_transaction)
+        self.assertEqual(list(index), ['1'])
+        self.assertEqual(index['1'], quote)
+
+if __name__ == '__main__':
+    unittest.main()
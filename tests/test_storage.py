@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+
+import vebyastquotebot.storage
+
+def make_quote(quote_id):
+    return {'id': quote_id, 'lines': [], 'quoted': None, 'server': None, 'channel': None}
+
+class JournalStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'quotes.json')
+        vebyastquotebot.storage.write_snapshot(self.filename, [])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def add(self, storage, index, quote_id):
+        ops = [vebyastquotebot.storage.add_op(make_quote(quote_id))]
+        vebyastquotebot.storage.apply_ops(index, ops)
+        storage.save(index, ops)
+
+    def test_append_after_partial_entry(self):
+        storage = vebyastquotebot.storage.JournalStorage(self.filename)
+        self.add(storage, storage.load(), '1')
+        # a crash partway through the next append
+        with open(storage.journal_filename, 'a') as jf:
+            jf.write('{"op": "add", "quo')
+
+        storage = vebyastquotebot.storage.JournalStorage(self.filename)
+        index = storage.load()
+        self.assertEqual(list(index), ['1'])
+        self.add(storage, index, '3')
+
+        reloaded = vebyastquotebot.storage.JournalStorage(self.filename).load()
+        self.assertEqual(list(reloaded), ['1', '3'])
+
+class SnapshotStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'quotes.json')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_load(self):
+        quotes = [make_quote(quote_id) for quote_id in ['1', '2', '5']]
+        vebyastquotebot.storage.write_snapshot(self.filename, quotes)
+        index = vebyastquotebot.storage.SnapshotStorage(self.filename).load()
+        self.assertEqual(list(index), ['1', '2', '5'])
+
+    def test_load_empty(self):
+        vebyastquotebot.storage.write_snapshot(self.filename, [])
+        self.assertEqual(len(vebyastquotebot.storage.SnapshotStorage(self.filename).load()), 0)
+
+if __name__ == '__main__':
+    unittest.main()
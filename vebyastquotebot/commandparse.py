@@ -0,0 +1,61 @@
+import pyparsing as ps
+
+# the grammars for recognizing commands. these get built once (the mention
+# grammar as soon as we know our own user id) instead of once per message, and
+# each parse has a cheap string-prefix check in front of it, since the vast
+# majority of messages the bot sees aren't addressed to it at all.
+
+CHANNEL_ID_GRAMMAR = ps.Or((
+    ps.Word(ps.nums).setResultsName('channel_id'),
+    '<#' + ps.Word(ps.nums).setResultsName('channel_id') + '>',
+))
+
+def channel_id_parse(arg):
+    try:
+        return (CHANNEL_ID_GRAMMAR.parseString(arg)['channel_id'], None)
+    except ps.ParseException as e:
+        return (None, e)
+
+USER_ID_GRAMMAR = ps.Or((
+    ps.Word(ps.nums).setResultsName('user_id'),
+    '<@' + ps.Optional('!') + ps.Word(ps.nums).setResultsName('user_id') + '>',
+))
+
+def user_id_parse(arg):
+    try:
+        return (USER_ID_GRAMMAR.parseString(arg)['user_id'], None)
+    except ps.ParseException as e:
+        return (None, e)
+
+class CommandGrammar(object):
+    def __init__(self, user_id, commands):
+        self.mention_prefixes = (
+            '<@' + user_id + '>',
+            '<@!' + user_id + '>',
+        )
+        self.command_prefixes = tuple(com.lower() for com in commands)
+        self.mention = (
+            ('<@' + ps.Optional('!') + user_id + '>').setResultsName('user_id')
+            + ps.restOfLine.setResultsName('command_line')
+        )
+        self.command = (
+            ps.Or(ps.CaselessKeyword(com) for com in commands).setResultsName('command') +
+            ps.restOfLine.setResultsName('argstring')
+        )
+
+    def public_message_parse(self, command_line):
+        if not command_line.lstrip().startswith(self.mention_prefixes):
+            return (None, None)
+        try:
+            parseresult = self.mention.parseString(command_line)
+            return (parseresult['command_line'], None)
+        except ps.ParseException as e:
+            return (None, e)
+
+    def command_line_parse(self, command_line):
+        if not command_line.lstrip().lower().startswith(self.command_prefixes):
+            return (None, None)
+        try:
+            return (self.command.parseString(command_line), None)
+        except ps.ParseException as e:
+            return (None, e)
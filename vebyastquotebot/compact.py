@@ -0,0 +1,201 @@
+import datetime
+import re
+import sys
+
+# a compact in-memory form for quotes. every line of a quote used to be its own
+# dict repeating the author's name, id and colour, plus timestamps as strings;
+# here authors live in a shared table, repeated strings are interned and
+# timestamps are integers. the records answer the same `[key]` / `.get(key)`
+# lookups as the json dicts, and to_json turns them back into exactly the dicts
+# they came from, so this only matters between loading and saving.
+#
+# anything that doesn't look exactly like what message_to_json and /add produce
+# (extra keys, a different key order, odd timestamps) is left as a plain dict,
+# which keeps the round trip byte-for-byte.
+#
+# the tradeoff is load time: building the records takes about two and a half
+# times as long as parsing the json did in the first place.
+# benchmarks/bench_compact.py puts 20k quotes at about 3.5s to load as records
+# against 1.0s as plain dicts, for roughly a third of the memory (264 bytes per
+# line instead of 753).
+
+LINE_KEYS = ['author', 'author_id', 'timestamp', 'edited', 'content', 'authorcolor', 'attachments']
+QUOTE_KEYS = ['id', 'lines', 'quoted', 'server', 'channel']
+# for checking a dict's keys without building a list of them
+LINE_KEY_TUPLE = tuple(LINE_KEYS)
+QUOTE_KEY_TUPLE = tuple(QUOTE_KEYS)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+UTC = datetime.timezone.utc
+AWARE_EPOCH = EPOCH.replace(tzinfo=UTC)
+
+ISO_TIMESTAMP = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{6}))?(\+00:00)?$', re.ASCII)
+
+def intern(s):
+    return sys.intern(s) if isinstance(s, str) else s
+
+# 'YYYY-MM-DD' -> days since the epoch, or None if it isn't a real date. an
+# archive only spans a few thousand days, and working out the date was most of
+# the cost of encoding a timestamp.
+EPOCH_DAYS = {}
+
+def epoch_days(date):
+    try:
+        return EPOCH_DAYS[date]
+    except KeyError:
+        pass
+    try:
+        days = (datetime.date(int(date[0:4]), int(date[5:7]), int(date[8:10])) - EPOCH.date()).days
+    except ValueError:
+        days = None
+    EPOCH_DAYS[date] = days
+    return days
+
+def encode_timestamp(s, aware):
+    # microseconds since the epoch if that turns back into the same string,
+    # otherwise the string itself. isoformat leaves out the fraction exactly
+    # when it's zero, so anything else that matches comes back out unchanged.
+    if not isinstance(s, str):
+        return s
+    m = ISO_TIMESTAMP.match(s)
+    if not m:
+        return s
+    (_, _, _, hour, minute, second, fraction, offset) = m.groups()
+    if bool(offset) != aware or fraction == '000000':
+        return s
+    days = epoch_days(s[:10])
+    (hour, minute, second) = (int(hour), int(minute), int(second))
+    if days is None or hour > 23 or minute > 59 or second > 59:
+        return s
+    return (((days * 24 + hour) * 60 + minute) * 60 + second) * 1000000 + (int(fraction) if fraction else 0)
+
+def decode_timestamp(value, aware):
+    if not isinstance(value, int):
+        return value
+    if aware:
+        return (AWARE_EPOCH + datetime.timedelta(microseconds=value)).isoformat()
+    return (EPOCH + datetime.timedelta(microseconds=value)).isoformat()
+
+class Author(object):
+    __slots__ = ('name', 'id', 'color')
+
+    def __init__(self, name, id, color):
+        self.name = name
+        self.id = id
+        self.color = color
+
+class AuthorTable(object):
+    def __init__(self):
+        self.authors = {}
+
+    def get(self, name, id, color):
+        key = (name, id, color)
+        author = self.authors.get(key)
+        if author is None:
+            author = Author(intern(name), intern(id), intern(color))
+            self.authors[key] = author
+        return author
+
+    def __len__(self):
+        return len(self.authors)
+
+AUTHORS = AuthorTable()
+
+class Record(object):
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        try:
+            getter = self.GETTERS[key]
+        except KeyError:
+            raise KeyError(key)
+        return getter(self)
+
+    def get(self, key, default=None):
+        getter = self.GETTERS.get(key)
+        return getter(self) if getter else default
+
+    def __contains__(self, key):
+        return key in self.GETTERS
+
+    def keys(self):
+        return list(self.KEYS)
+
+class Line(Record):
+    __slots__ = ('author', 'timestamp', 'edited', 'content', 'attachments')
+    KEYS = LINE_KEYS
+    GETTERS = {
+        'author': lambda l: l.author.name,
+        'author_id': lambda l: l.author.id,
+        'timestamp': lambda l: decode_timestamp(l.timestamp, True),
+        'edited': lambda l: decode_timestamp(l.edited, True),
+        'content': lambda l: l.content,
+        'authorcolor': lambda l: l.author.color,
+        'attachments': lambda l: list(l.attachments),
+    }
+
+    def __init__(self, author, timestamp, edited, content, attachments):
+        self.author = author
+        self.timestamp = timestamp
+        self.edited = edited
+        self.content = content
+        self.attachments = attachments
+
+    def to_json(self):
+        return {key: self[key] for key in LINE_KEYS}
+
+class Quote(Record):
+    __slots__ = ('id', 'lines', 'quoted', 'server', 'channel')
+    KEYS = QUOTE_KEYS
+    GETTERS = {
+        'id': lambda q: q.id,
+        'lines': lambda q: q.lines,
+        'quoted': lambda q: decode_timestamp(q.quoted, False),
+        'server': lambda q: q.server,
+        'channel': lambda q: q.channel,
+    }
+
+    def __init__(self, id, lines, quoted, server, channel):
+        self.id = id
+        self.lines = lines
+        self.quoted = quoted
+        self.server = server
+        self.channel = channel
+
+    def to_json(self):
+        return {
+            'id': self.id,
+            'lines': [to_json(line) for line in self.lines],
+            'quoted': self['quoted'],
+            'server': self.server,
+            'channel': self.channel,
+        }
+
+NO_ATTACHMENTS = ()
+
+def line_from_json(line, authors=AUTHORS):
+    if not isinstance(line, dict) or tuple(line) != LINE_KEY_TUPLE or not isinstance(line['attachments'], list):
+        return line
+    return Line(
+        author=authors.get(line['author'], line['author_id'], line['authorcolor']),
+        timestamp=encode_timestamp(line['timestamp'], True),
+        edited=encode_timestamp(line['edited'], True),
+        content=line['content'],
+        attachments=tuple(line['attachments']) or NO_ATTACHMENTS,
+    )
+
+def from_json(quote, authors=AUTHORS):
+    if not isinstance(quote, dict) or tuple(quote) != QUOTE_KEY_TUPLE or not isinstance(quote['lines'], list):
+        return quote
+    return Quote(
+        id=quote['id'],
+        lines=tuple(line_from_json(line, authors) for line in quote['lines']),
+        quoted=encode_timestamp(quote['quoted'], False),
+        server=intern(quote['server']),
+        channel=intern(quote['channel']),
+    )
+
+def to_json(record):
+    if isinstance(record, Record):
+        return record.to_json()
+    return record
@@ -0,0 +1,97 @@
+import asyncio
+import datetime
+import logging
+import discord
+
+# discord's bulk delete takes at most 100 messages at a time and refuses
+# anything older than two weeks. the margin keeps us clear of messages that
+# cross that line while the request is in flight.
+BULK_DELETE_MAX = 100
+BULK_DELETE_MAX_AGE = datetime.timedelta(days=14)
+BULK_DELETE_MARGIN = datetime.timedelta(minutes=5)
+
+SINGLE_DELETE_CONCURRENCY = 3
+SINGLE_DELETE_RETRIES = 5
+
+def split_by_age(messages, now=None):
+    now = now or datetime.datetime.utcnow()
+    cutoff = now - BULK_DELETE_MAX_AGE + BULK_DELETE_MARGIN
+    young = [m for m in messages if m.timestamp > cutoff]
+    old = [m for m in messages if m.timestamp <= cutoff]
+    return (young, old)
+
+def is_rate_limited(e):
+    return getattr(getattr(e, 'response', None), 'status', None) == 429
+
+async def delete_one(client, message, retries=SINGLE_DELETE_RETRIES):
+    for attempt in range(retries):
+        try:
+            await client.delete_message(message)
+            return True
+        except discord.NotFound:
+            # somebody beat us to it
+            return False
+        except discord.HTTPException as e:
+            if not is_rate_limited(e) or attempt + 1 == retries:
+                raise
+            wait = 2 ** attempt
+            logging.warning('rate limited deleting message', extra = {'custom': {
+                'messageid': message.id,
+                'retry_in': wait,
+            }})
+            await asyncio.sleep(wait)
+    return False
+
+async def delete_singly(client, messages, progress, concurrency=SINGLE_DELETE_CONCURRENCY):
+    semaphore = asyncio.Semaphore(concurrency)
+    deleted = []
+
+    async def worker(message):
+        async with semaphore:
+            if await delete_one(client, message):
+                deleted.append(message)
+                await progress(len(deleted))
+
+    await asyncio.gather(*(worker(m) for m in messages))
+    return deleted
+
+async def delete_messages(client, messages, progress=None):
+    # deletes `messages` as fast as discord lets us, calling `progress` with
+    # the running number of deleted messages. returns the deleted messages.
+    async def no_progress(ndeleted):
+        pass
+    progress = progress or no_progress
+
+    (young, old) = split_by_age(messages)
+    deleted = []
+    fallback = []
+
+    for i in range(0, len(young), BULK_DELETE_MAX):
+        batch = young[i:i + BULK_DELETE_MAX]
+        if len(batch) < 2:
+            # the bulk endpoint wants at least two
+            fallback.extend(batch)
+            continue
+        try:
+            await client.delete_messages(batch)
+        except discord.HTTPException as e:
+            # bulk deleting needs manage messages, even for our own posts, and
+            # doesn't work in DMs. it also refuses the whole batch if discord's
+            # clock puts any of it past the age limit when ours didn't. one at
+            # a time works in all of those cases.
+            logging.warning('bulk delete failed, deleting one at a time', extra = {'custom': {
+                'error': str(e),
+                'num_remaining': len(young) - i,
+            }})
+            fallback.extend(young[i:])
+            break
+        deleted.extend(batch)
+        await progress(len(deleted))
+
+    already = len(deleted)
+
+    async def single_progress(ndeleted):
+        await progress(already + ndeleted)
+
+    deleted.extend(await delete_singly(client, fallback + old, single_progress))
+    return deleted
@@ -0,0 +1,55 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+
+# somewhere other than the event loop to run blocking work. run_io is for
+# things that mostly wait (git, writing files) and goes to a thread pool;
+# run_cpu is for things that mostly compute and goes to a process pool, so it
+# doesn't hold the GIL the loop needs. run_cpu's function and arguments get
+# pickled, so they have to be module-level functions and plain data.
+#
+# a pool size of 0 turns that pool off: with no processes, run_cpu uses the
+# thread pool, and with no threads everything runs right there on the loop,
+# the way it did before any of this existed.
+
+class Executors(object):
+    def __init__(self, *, threads=4, processes=1):
+        self.threads = threads
+        self.processes = processes
+        self.thread_pool = None
+        self.process_pool = None
+
+    def configure(self, *, threads=None, processes=None):
+        self.shutdown()
+        if threads is not None:
+            self.threads = threads
+        if processes is not None:
+            self.processes = processes
+        logging.info('configured executors', extra = {'custom': {
+            'threads': self.threads,
+            'processes': self.processes,
+        }})
+
+    async def run_io(self, f, *args):
+        if not self.threads:
+            return f(*args)
+        if self.thread_pool is None:
+            self.thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+        return await asyncio.get_event_loop().run_in_executor(self.thread_pool, functools.partial(f, *args))
+
+    async def run_cpu(self, f, *args):
+        if not self.processes:
+            return await self.run_io(f, *args)
+        if self.process_pool is None:
+            self.process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.processes)
+        return await asyncio.get_event_loop().run_in_executor(self.process_pool, functools.partial(f, *args))
+
+    def shutdown(self):
+        for pool in (self.thread_pool, self.process_pool):
+            if pool is not None:
+                pool.shutdown(wait=True)
+        self.thread_pool = None
+        self.process_pool = None
+
+EXECUTORS = Executors()
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import time
+
+# the "Processing..." message a command edits as it goes. progress updates are
+# coalesced: at most one edit goes out every `interval` seconds, carrying
+# whatever the latest text is by then, and texts nobody got to see in between
+# are simply skipped. the final text (a result or an error) always gets sent,
+# and after it has been nothing else will overwrite it.
+#
+# edits go out one at a time, in order, so a slow progress edit can't land on
+# top of the final one.
+
+class FeedbackUpdater(object):
+    def __init__(self, client, message, *, interval=1.0):
+        self.client = client
+        self.message = message
+        self.interval = interval
+        self.pending = None
+        self.sent = message.content
+        self.last_edit = None
+        self.finished = False
+        self.task = None
+        self.lock = asyncio.Lock()
+
+    @property
+    def id(self):
+        return self.message.id
+
+    def update(self, text):
+        # doesn't wait for anything; the edit happens in the background
+        if self.finished:
+            return
+        self.pending = text
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while self.pending is not None and not self.finished:
+            if self.last_edit is not None:
+                wait = self.last_edit + self.interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            try:
+                await self.send_pending()
+            except Exception as e:
+                # progress is best-effort; finish() will try again with the
+                # text that matters
+                logging.warning('could not update feedback', extra = {'custom': {
+                    'messageid': self.message.id,
+                    'error': str(e),
+                }})
+                return
+
+    async def send_pending(self):
+        async with self.lock:
+            (text, self.pending) = (self.pending, None)
+            if text is None or text == self.sent:
+                return
+            self.last_edit = time.monotonic()
+            self.message = await self.client.edit_message(self.message, text) or self.message
+            self.sent = text
+
+    async def finish(self, text):
+        # can be called again later (to tack on a git status, say); each call
+        # replaces the last
+        self.finished = True
+        self.pending = text
+        await self.send_pending()
+        if self.sent != text:
+            # a background edit picked it up and failed; this one raises
+            self.pending = text
+            await self.send_pending()
+
+    async def delete(self):
+        self.finished = True
+        async with self.lock:
+            await self.client.delete_message(self.message)
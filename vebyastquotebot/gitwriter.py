@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import vebyastquotebot.executors
+import vebyastquotebot.metrics
+
+# moves git commit/push off the event loop. changes that arrive within `delay`
+# seconds of each other get folded into a single commit, and pushes that fail
+# are retried with exponential backoff before giving up.
+
+class GitWriter(object):
+    def __init__(self, store, *, delay=5.0, retries=5, backoff=2.0, loop=None):
+        self.store = store
+        self.delay = delay
+        self.retries = retries
+        self.backoff = backoff
+        self.loop = loop
+        self.pending = []
+        self.task = None
+        # the current wait before a flush, which close() cuts short
+        self.sleeping = None
+        self.closing = False
+
+    def get_loop(self):
+        return self.loop or asyncio.get_event_loop()
+
+    def submit(self, message, push=False):
+        future = self.get_loop().create_future()
+        self.pending.append((message, push, future))
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run(), loop=self.get_loop())
+        return future
+
+    async def run(self):
+        while self.pending:
+            if not self.closing:
+                self.sleeping = asyncio.ensure_future(asyncio.sleep(self.delay), loop=self.get_loop())
+                # asyncio.wait doesn't raise when close() cancels the sleep
+                await asyncio.wait([self.sleeping])
+                self.sleeping = None
+            (batch, self.pending) = (self.pending, [])
+            await self.flush(batch)
+
+    async def close(self):
+        # flushes whatever is pending right away instead of after `delay`, so
+        # that stopping the bot doesn't lose the last few changes. anything
+        # submitted after this gets flushed right away too.
+        self.closing = True
+        if self.sleeping is not None:
+            self.sleeping.cancel()
+        if self.task is not None:
+            await self.task
+
+    def commit(self, files, message):
+        repo = self.store.get_repo()
+        repo.index.add(files)
+        repo.index.commit(message)
+
+    def push(self):
+        self.store.get_repo().remote().push()
+
+    async def flush(self, batch):
+        messages = [message for (message, _, _) in batch]
+        if len(messages) == 1:
+            message = messages[0]
+        else:
+            message = '{n} changes\n\n{messages}'.format(
+                n=len(messages),
+                messages='\n'.join(messages),
+            )
+        dopush = any(push for (_, push, _) in batch)
+        futures = [future for (_, _, future) in batch]
+
+        try:
+            files = await self.store.prepare_commit_async()
+            with vebyastquotebot.metrics.METRICS.timer('quotedb_commit'):
+                await vebyastquotebot.executors.EXECUTORS.run_io(self.commit, files, message)
+        except Exception as e:
+            logging.error('git commit failed', extra = {'custom': {
+                'error': str(e),
+                'num_changes': len(batch),
+            }})
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        status = 'Committed {} change(s).'.format(len(batch))
+        if dopush:
+            for attempt in range(self.retries):
+                try:
+                    with vebyastquotebot.metrics.METRICS.timer('quotedb_push'):
+                        await vebyastquotebot.executors.EXECUTORS.run_io(self.push)
+                    status = 'Committed and pushed {} change(s).'.format(len(batch))
+                    break
+                except Exception as e:
+                    wait = self.backoff * (2 ** attempt)
+                    logging.warning('git push failed', extra = {'custom': {
+                        'error': str(e),
+                        'attempt': attempt + 1,
+                        'retry_in': wait,
+                    }})
+                    status = 'Committed {} change(s), but pushing failed: {}'.format(len(batch), str(e))
+                    if attempt + 1 < self.retries:
+                        await asyncio.sleep(wait)
+
+        logging.info('git writer flushed', extra = {'custom': {
+            'num_changes': len(batch),
+            'pushed': dopush,
+            'status': status,
+        }})
+        for future in futures:
+            if not future.done():
+                future.set_result(status)
@@ -0,0 +1,212 @@
+import asyncio
+import bisect
+import collections
+import datetime
+import logging
+import time
+
+# discord ids are snowflakes: the top bits are milliseconds since this epoch,
+# so ids sort the same way messages do in time.
+DISCORD_EPOCH_MS = 1420070400000
+
+def snowflake_from_datetime(dt, high=False):
+    ms = int((dt - datetime.datetime(1970, 1, 1)).total_seconds() * 1000) - DISCORD_EPOCH_MS
+    return (ms << 22) + ((2 ** 22 - 1) if high else 0)
+
+def sort_key(boundary, high=False):
+    if boundary is None:
+        return None
+    if isinstance(boundary, datetime.datetime):
+        return snowflake_from_datetime(boundary, high=high)
+    return int(boundary.id)
+
+
+# a contiguous stretch of one channel's history, oldest first, running from
+# `messages[0]` up to the present. it stays contiguous because new messages get
+# appended from the gateway as they arrive.
+class ChannelHistory(object):
+    def __init__(self, channel):
+        self.channel = channel
+        self.messages = []
+        self.ids = []
+        # true once we've fetched all the way back to the start of the channel
+        self.complete = False
+        self.created = time.monotonic()
+        # held while extending, so two lookups can't both prepend the same page
+        self.lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def oldest(self):
+        return self.messages[0] if self.messages else None
+
+    def prepend(self, older):
+        # `older` comes straight from logs_from, so it's newest first
+        older = list(reversed(older))
+        if self.ids:
+            # the first fetch for a channel is for the latest messages, and the
+            # gateway can append some of the same ones while it's in flight;
+            # the appended copies are at least as fresh, so keep those
+            older = [m for m in older if int(m.id) < self.ids[0]]
+        self.messages[:0] = older
+        self.ids[:0] = [int(m.id) for m in older]
+
+    def append(self, message):
+        key = int(message.id)
+        i = bisect.bisect_left(self.ids, key)
+        if i < len(self.ids) and self.ids[i] == key:
+            self.messages[i] = message
+            return
+        self.ids.insert(i, key)
+        self.messages.insert(i, message)
+
+    def replace(self, message):
+        key = int(message.id)
+        i = bisect.bisect_left(self.ids, key)
+        if i < len(self.ids) and self.ids[i] == key:
+            self.messages[i] = message
+
+    def remove(self, message_id):
+        key = int(message_id)
+        i = bisect.bisect_left(self.ids, key)
+        if i < len(self.ids) and self.ids[i] == key:
+            del self.ids[i]
+            del self.messages[i]
+
+    def between(self, after_key, before_key):
+        lo = 0 if after_key is None else bisect.bisect_right(self.ids, after_key)
+        hi = len(self.ids) if before_key is None else bisect.bisect_left(self.ids, before_key)
+        return self.messages[lo:hi]
+
+    def covers(self, after_key):
+        # everything newer than `after_key` is in here
+        if self.complete:
+            return True
+        return bool(self.ids) and after_key is not None and after_key >= self.ids[0] - 1
+
+
+# per-channel history caches, least recently used first. `logs_from` has the
+# same meaning as client.logs_from, but only goes to discord for the part of the
+# requested range that isn't cached yet.
+class HistoryCache(object):
+    def __init__(self, *, max_channels=50, max_messages_per_channel=5000, ttl=600):
+        self.max_channels = max_channels
+        self.max_messages_per_channel = max_messages_per_channel
+        self.ttl = ttl
+        self.histories = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.fetched = 0
+
+    def get_history(self, channel):
+        history = self.histories.get(channel.id)
+        if history is not None and time.monotonic() - history.created > self.ttl:
+            # we can miss edits to messages the client doesn't have cached, so
+            # don't trust anything for too long
+            del self.histories[channel.id]
+            history = None
+        if history is None:
+            history = ChannelHistory(channel)
+            self.histories[channel.id] = history
+            while len(self.histories) > self.max_channels:
+                self.histories.popitem(last=False)
+        self.histories.move_to_end(channel.id)
+        return history
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'fetched': self.fetched,
+            'num_channels': len(self.histories),
+        }
+
+    async def fetch_older(self, client, history, limit):
+        # always walk backwards from the oldest message we have, so that the
+        # cached stretch stays contiguous
+        older = []
+        async for log in client.logs_from(
+                history.channel,
+                limit=limit,
+                before=history.oldest()):
+            older.append(log)
+        older.sort(key=lambda m: int(m.id), reverse=True)
+        self.fetched += len(older)
+        history.prepend(older)
+        if len(older) < limit:
+            history.complete = True
+        return len(older)
+
+    async def fetch_direct(self, client, channel, *, limit, before, after):
+        self.misses += 1
+        self.log_lookup(channel, False)
+        logs = []
+        async for log in client.logs_from(channel, limit=limit, before=before, after=after):
+            logs.append(log)
+        self.fetched += len(logs)
+        return logs
+
+    async def logs_from(self, client, channel, *, limit, before=None, after=None):
+        history = self.get_history(channel)
+        async with history.lock:
+            return await self.locked_logs_from(client, history, limit=limit, before=before, after=after)
+
+    async def locked_logs_from(self, client, history, *, limit, before, after):
+        channel = history.channel
+        before_key = sort_key(before)
+        after_key = sort_key(after, high=True)
+
+        if (not history.complete and history.ids and before_key is not None
+                and before_key <= history.ids[0]):
+            # the whole range is older than anything we have, and the cached
+            # stretch has to stay contiguous, so caching it would mean fetching
+            # everything in between as well
+            return await self.fetch_direct(client, channel, limit=limit, before=before, after=after)
+
+        fetched_any = False
+        while True:
+            candidates = history.between(after_key, before_key)
+            if len(candidates) >= limit or history.covers(after_key):
+                break
+            if len(history) >= self.max_messages_per_channel:
+                # too far back to be worth caching; just ask discord directly
+                return await self.fetch_direct(client, channel, limit=limit, before=before, after=after)
+            fetched_any = True
+            await self.fetch_older(client, history, max(limit - len(candidates), 100))
+
+        if fetched_any:
+            self.misses += 1
+        else:
+            self.hits += 1
+        self.log_lookup(channel, not fetched_any)
+
+        candidates = history.between(after_key, before_key)
+        return list(reversed(candidates[-limit:]))
+
+    def log_lookup(self, channel, hit):
+        logging.info('channel history lookup', extra = {'custom': dict(
+            self.stats(),
+            channel=channel.id,
+            hit=hit,
+        )})
+
+    def on_message(self, message):
+        history = self.histories.get(message.channel.id)
+        if history is not None:
+            history.append(message)
+
+    def on_message_edit(self, message):
+        history = self.histories.get(message.channel.id)
+        if history is not None:
+            history.replace(message)
+
+    def on_message_delete(self, message):
+        history = self.histories.get(message.channel.id)
+        if history is not None:
+            history.remove(message.id)
+
+    def mark_stale(self):
+        self.histories.clear()
+
+HISTORY_CACHE = HistoryCache()
@@ -0,0 +1,159 @@
+import asyncio
+import bisect
+import collections
+import contextlib
+import functools
+import logging
+import time
+
+# timings for the phases a command goes through (parsing, pulling logs,
+# searching, loading and saving quotes, git, talking to discord), kept as
+# histograms. a summary goes to the log every so often, and if METRICS_PORT is
+# set they're also served as prometheus-style text for scraping.
+
+# upper bounds, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # one more than there are buckets, for everything past the last one
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # the upper bound of the bucket the quantile falls in, which is as
+        # close as the buckets let us get
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for (bound, n) in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'max': round(self.max, 6),
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+        }
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def format_labels(labels):
+    return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for (k, v) in labels)
+
+class Metrics(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix='quotebot'):
+        self.buckets = buckets
+        self.prefix = prefix
+        # (phase, label key) -> Histogram
+        self.histograms = collections.OrderedDict()
+
+    def observe(self, phase, seconds, **labels):
+        key = (phase, label_key(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.buckets)
+        histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, phase, **labels):
+        # works around awaits too, since it only looks at the clock on the
+        # way in and the way out
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start, **labels)
+
+    def timed(self, phase, **labels):
+        def decorator(f):
+            if asyncio.iscoroutinefunction(f):
+                @functools.wraps(f)
+                async def wrapper(*args, **kwargs):
+                    with self.timer(phase, **labels):
+                        return await f(*args, **kwargs)
+            else:
+                @functools.wraps(f)
+                def wrapper(*args, **kwargs):
+                    with self.timer(phase, **labels):
+                        return f(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        return [
+            dict(histogram.summary(), phase=phase, **dict(labels))
+            for ((phase, labels), histogram) in self.histograms.items()
+        ]
+
+    def log_summary(self):
+        logging.info('metrics summary', extra = {'custom': {
+            'phases': self.summary(),
+        }})
+
+    def prometheus_text(self):
+        name = self.prefix + '_phase_seconds'
+        out = [
+            '# HELP {} Time spent in each phase of handling commands.'.format(name),
+            '# TYPE {} histogram'.format(name),
+        ]
+        for ((phase, labels), histogram) in self.histograms.items():
+            labels = (('phase', phase),) + labels
+            cumulative = 0
+            for (bound, n) in zip(histogram.buckets, histogram.counts):
+                cumulative += n
+                out.append('{}_bucket{{{},le="{}"}} {}'.format(name, format_labels(labels), bound, cumulative))
+            out.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, format_labels(labels), histogram.count))
+            out.append('{}_sum{{{}}} {}'.format(name, format_labels(labels), histogram.sum))
+            out.append('{}_count{{{}}} {}'.format(name, format_labels(labels), histogram.count))
+        return '\n'.join(out) + '\n'
+
+    async def report_every(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            if self.histograms:
+                self.log_summary()
+
+    async def handle_scrape(self, reader, writer):
+        # the least HTTP that a scraper (or curl) will accept: read the
+        # request up to the blank line and answer anything with the metrics
+        try:
+            while True:
+                line = await reader.readline()
+                if not line or line in (b'\r\n', b'\n'):
+                    break
+            body = self.prometheus_text().encode('utf-8')
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n' +
+                         'Content-Length: {}\r\n\r\n'.format(len(body)).encode('ascii') +
+                         body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=9100):
+        server = await asyncio.start_server(self.handle_scrape, host, port)
+        logging.info('serving metrics', extra = {'custom': {
+            'host': host,
+            'port': port,
+        }})
+        return server
+
+METRICS = Metrics()
@@ -0,0 +1,201 @@
+import asyncio
+import collections
+import contextlib
+import logging
+import re
+import time
+import vebyastquotebot.metrics
+
+# keeps an eye on the bot while it runs: how late the event loop wakes up when
+# asked to (anything that blocks it, a command handler included, shows up as
+# lag), how many commands are in flight, and how often and for how long
+# discord has made us wait because of rate limits. a summary goes to the log
+# every so often, and /stats prints the same numbers.
+#
+# discord.py handles rate limits inside its http client and only says so in
+# its log, so that's where the waits get picked up from.
+
+RATE_LIMIT_LOGGER = 'discord.http'
+
+# discord.py's bucket names look like '<method>:<channel id>:<server id>:<path>',
+# where the path still has its {placeholders} in. the method and path together
+# make a good endpoint name, and leave the ids out so it doesn't get split up
+# per channel and server.
+#
+# the waits are formatted with '{:.2}', which turns 10 seconds or more into
+# something like '1.2e+01'
+SECONDS = r'([0-9.]+(?:e[+-]?[0-9]+)?)'
+RATE_LIMITED = re.compile(r'We are being rate limited\. Retrying in ' + SECONDS + r' seconds\. Handled under the bucket "(.*)"')
+GLOBAL_RATE_LIMITED = re.compile(r'Global rate limit has been hit\. Retrying in ' + SECONDS + r' seconds\.')
+BUCKET_EXHAUSTED = re.compile(r'A rate limit bucket has been exhausted \(bucket: (.*), retry: ' + SECONDS + r'\)\.')
+
+def bucket_endpoint(bucket):
+    parts = bucket.split(':', 3)
+    if len(parts) != 4:
+        return bucket
+    (method, _, _, path) = parts
+    return method + ' ' + path
+
+class RateLimitHandler(logging.Handler):
+    def __init__(self, monitor):
+        super().__init__(logging.INFO)
+        self.monitor = monitor
+
+    def emit(self, record):
+        try:
+            message = record.getMessage()
+        except Exception:
+            return
+        match = RATE_LIMITED.search(message)
+        if match:
+            self.monitor.rate_limited(bucket_endpoint(match.group(2)), float(match.group(1)))
+            return
+        match = GLOBAL_RATE_LIMITED.search(message)
+        if match:
+            self.monitor.rate_limited('global', float(match.group(1)))
+            return
+        match = BUCKET_EXHAUSTED.search(message)
+        if match:
+            # not a 429, but discord.py sleeps it out all the same
+            self.monitor.rate_limited(bucket_endpoint(match.group(1)), float(match.group(2)))
+
+class RateLimits(object):
+    def __init__(self):
+        self.count = 0
+        self.wait = 0.0
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'wait': round(self.wait, 3),
+        }
+
+class Monitor(object):
+    def __init__(self, metrics=None):
+        self.metrics = metrics or vebyastquotebot.metrics.METRICS
+        self.started = time.monotonic()
+        # command name -> number of them running right now
+        self.in_flight = collections.Counter()
+        self.handled = 0
+        self.failed = 0
+        # loop lag since the last summary, and the worst seen since startup
+        self.lag = vebyastquotebot.metrics.Histogram()
+        self.last_lag = None
+        self.worst_lag = 0.0
+        self.worst_lag_commands = []
+        # endpoint -> RateLimits, since startup
+        self.rate_limits = collections.OrderedDict()
+
+    def install(self, logger_name=RATE_LIMIT_LOGGER):
+        logging.getLogger(logger_name).addHandler(RateLimitHandler(self))
+
+    @contextlib.contextmanager
+    def command(self, name):
+        self.in_flight[name] += 1
+        try:
+            yield
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight[name] -= 1
+            if not self.in_flight[name]:
+                del self.in_flight[name]
+            self.handled += 1
+
+    def rate_limited(self, endpoint, wait):
+        limits = self.rate_limits.get(endpoint)
+        if limits is None:
+            limits = self.rate_limits[endpoint] = RateLimits()
+        limits.count += 1
+        limits.wait += wait
+        self.metrics.observe('rate_limit_wait', wait, endpoint=endpoint)
+
+    def observe_lag(self, lag):
+        self.last_lag = lag
+        self.lag.observe(lag)
+        self.metrics.observe('loop_lag', lag)
+        if lag > self.worst_lag:
+            self.worst_lag = lag
+            # whatever was running when the loop stalled is the best lead on
+            # what stalled it
+            self.worst_lag_commands = sorted(self.in_flight)
+
+    async def sample_lag(self, interval):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.observe_lag(max(0.0, loop.time() - start - interval))
+
+    def summary(self):
+        return {
+            'uptime': round(time.monotonic() - self.started, 1),
+            'in_flight': sum(self.in_flight.values()),
+            'in_flight_commands': dict(self.in_flight),
+            'handled': self.handled,
+            'failed': self.failed,
+            'loop_lag': dict(self.lag.summary(), last=self.last_lag),
+            'worst_loop_lag': round(self.worst_lag, 6),
+            'worst_loop_lag_commands': self.worst_lag_commands,
+            'rate_limits': {
+                endpoint: limits.summary()
+                for (endpoint, limits) in self.rate_limits.items()
+            },
+        }
+
+    def log_summary(self):
+        logging.info('monitor summary', extra = {'custom': self.summary()})
+        # each summary's lag numbers cover the time since the one before
+        self.lag = vebyastquotebot.metrics.Histogram()
+
+    async def report_every(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.log_summary()
+
+    def run(self, *, lag_interval, report_interval, loop=None):
+        loop = loop or asyncio.get_event_loop()
+        return [
+            loop.create_task(self.sample_lag(lag_interval)),
+            loop.create_task(self.report_every(report_interval)),
+        ]
+
+def format_seconds(seconds):
+    if seconds is None:
+        return '-'
+    return '{:.1f}ms'.format(1000 * seconds)
+
+def format_stats(summary):
+    lag = summary['loop_lag']
+    lines = [
+        'Uptime: {:.0f}s'.format(summary['uptime']),
+        'Commands in flight: {}{}'.format(
+            summary['in_flight'],
+            ' ({})'.format(', '.join(
+                '{} {}'.format(n, command) for (command, n) in sorted(summary['in_flight_commands'].items())
+            )) if summary['in_flight'] else '',
+        ),
+        'Commands handled: {} ({} failed)'.format(summary['handled'], summary['failed']),
+        'Loop lag: last {} p50 {} p99 {} max {} (over {} samples)'.format(
+            format_seconds(lag['last']),
+            format_seconds(lag['p50']),
+            format_seconds(lag['p99']),
+            format_seconds(lag['max'] if lag['count'] else None),
+            lag['count'],
+        ),
+        'Worst loop lag: {}{}'.format(
+            format_seconds(summary['worst_loop_lag']),
+            ' (during {})'.format(', '.join(summary['worst_loop_lag_commands']))
+            if summary['worst_loop_lag_commands'] else '',
+        ),
+    ]
+    if summary['rate_limits']:
+        lines.append('Rate limited:')
+        for (endpoint, limits) in sorted(summary['rate_limits'].items(), key=lambda item: -item[1]['wait']):
+            lines.append('  {} x{}, waited {:.1f}s'.format(endpoint, limits['count'], limits['wait']))
+    else:
+        lines.append('Rate limited: never')
+    return '\n'.join(lines)
+
+MONITOR = Monitor()
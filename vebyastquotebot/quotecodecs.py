@@ -0,0 +1,71 @@
+import json
+import logging
+import vebyastquotebot.streaming
+
+# the formats a quote snapshot can be stored in. JSON is what the web UI reads
+# and what the bot has always written; the others are quicker to load or
+# smaller on disk, and when one of them is in use quotes.json gets exported
+# from it right before committing.
+#
+# a codec's dump takes an iterable of json-shaped quotes and may return an id
+# -> (start, end) offset index into what it wrote (only JSON does, which is
+# what makes lazy loading possible); load returns the list of quotes.
+
+class JsonCodec(object):
+    name = 'JSON'
+    suffix = '.json'
+    binary = False
+
+    def dump(self, quotes, f):
+        return vebyastquotebot.streaming.write_quotes(f, quotes)
+
+    def load(self, f):
+        return json.load(f)
+
+class CompactJsonCodec(object):
+    name = 'COMPACT_JSON'
+    suffix = '.compact.json'
+    binary = False
+
+    def dump(self, quotes, f):
+        f.write('[')
+        first = True
+        for quote in quotes:
+            if not first:
+                f.write(',')
+            f.write(json.dumps(quote, separators=(',', ':')))
+            first = False
+        f.write(']')
+
+    def load(self, f):
+        return json.load(f)
+
+class MsgpackCodec(object):
+    name = 'MSGPACK'
+    suffix = '.msgpack'
+    binary = True
+
+    def __init__(self, msgpack):
+        self.msgpack = msgpack
+
+    def dump(self, quotes, f):
+        self.msgpack.pack(list(quotes), f, use_bin_type=True)
+
+    def load(self, f):
+        return self.msgpack.unpack(f, raw=False)
+
+JSON = JsonCodec()
+
+CODECS = {codec.name: codec for codec in [JSON, CompactJsonCodec()]}
+
+try:
+    import msgpack
+    CODECS[MsgpackCodec.name] = MsgpackCodec(msgpack)
+except ImportError:
+    logging.debug('msgpack not installed; the MSGPACK quote codec is unavailable')
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError('unknown quote codec {} (available: {})'.format(name, ', '.join(sorted(CODECS))))
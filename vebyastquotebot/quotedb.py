@@ -1,10 +1,18 @@
+import asyncio
 import json
 import git
 import os
+import logging
+import vebyastquotebot.executors
+import vebyastquotebot.metrics
 import vebyastquotebot.orderedenum
+import vebyastquotebot.compact
+import vebyastquotebot.storage
+import vebyastquotebot.sqlitestore
 import pytz
 import re
 import discord
+import collections
 
 class QuoteDBCommit(vebyastquotebot.orderedenum.OrderedEnum):
     READONLY = 1
@@ -13,52 +21,281 @@ class QuoteDBCommit(vebyastquotebot.orderedenum.OrderedEnum):
     COMMIT = 4
     PUSH = 5
 
+class QuoteDBStorage(vebyastquotebot.orderedenum.OrderedEnum):
+    SNAPSHOT = 1
+    JOURNAL = 2
+    SQLITE = 3
+
+def make_storage(kind, filename, **kwargs):
+    if kind == QuoteDBStorage.JOURNAL:
+        return vebyastquotebot.storage.JournalStorage(filename, **kwargs)
+    if kind == QuoteDBStorage.SQLITE:
+        return vebyastquotebot.sqlitestore.SQLiteStorage(filename, **kwargs)
+    return vebyastquotebot.storage.SnapshotStorage(filename, **kwargs)
+
+QUOTES_FILENAME = 'quotes.json'
+
+# a long-lived copy of the quote database. it gets loaded once and then shared
+# between every QuoteDB context, and only gets re-read if something outside of
+# this process touches the file (which we detect using its stat signature).
+class QuoteStore(object):
+    def __init__(self, filename=QUOTES_FILENAME, storage=None):
+        self.filename = filename
+        self.storage = storage or vebyastquotebot.storage.SnapshotStorage(filename)
+        # quote id -> quote, kept in insertion order so that serializing it
+        # gives back the same list that was loaded
+        self.index = None
+        self.signature = None
+        # bumped every time the in-memory copy changes, so a QuoteDB context
+        # can tell whether someone else got in between its reads and its writes
+        self.version = 0
+        self.write_lock = None
+        # set while a save is running on a worker thread
+        self.writing = False
+        self.repo = None
+        # things that derive data from the quotes (search indexes and so on).
+        # each gets quotes_loaded(index) after a full load and
+        # quotes_changed(ops) after changes are saved.
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+        if self.index is not None:
+            listener.quotes_loaded(self.index)
+
+    def refresh(self):
+        if self.writing:
+            # a worker thread is partway through writing the in-memory copy
+            # out, so the disk is behind it rather than ahead of it
+            return self
+        signature = self.storage.signature()
+        if signature != self.signature:
+            self.load(signature)
+        return self
+
+    @property
+    def quotes(self):
+        return list(self.index.values())
+
+    def load(self, signature):
+        if hasattr(self.index, 'close'):
+            self.index.close()
+        with vebyastquotebot.metrics.METRICS.timer('quotedb_load'):
+            self.index = self.storage.load()
+        self.signature = signature
+        self.version += 1
+        logging.info('loaded quote database', extra = {'custom': {
+            'filename': self.filename,
+            'num_quotes': len(self.index),
+        }})
+        for listener in self.listeners:
+            listener.quotes_loaded(self.index)
+
+    def invalidate(self):
+        # forces a reload on the next refresh, throwing away any in-memory
+        # changes that never made it to disk
+        self.signature = None
+
+    def get_write_lock(self):
+        # created on first use so that it binds to the loop that's running
+        if self.write_lock is None:
+            self.write_lock = asyncio.Lock()
+        return self.write_lock
+
+    def apply(self, ops):
+        # re-check against disk right before writing, so a change made by
+        # another process gets loaded first instead of overwritten. a remove
+        # for a quote that's already gone is dropped rather than replayed.
+        self.refresh()
+        applied = [
+            op for op in ops
+            if op['op'] != 'remove' or op['id'] in self.index
+        ]
+        vebyastquotebot.storage.apply_ops(self.index, applied)
+        self.version += 1
+        return applied
+
+    def save(self, ops):
+        self.persist(ops)
+        self.notify(ops)
+
+    def persist(self, ops):
+        with vebyastquotebot.metrics.METRICS.timer('quotedb_save'):
+            self.storage.save(self.index, ops)
+        self.signature = self.storage.signature()
+
+    def notify(self, ops):
+        for listener in self.listeners:
+            listener.quotes_changed(ops)
+
+    def offloadable(self):
+        # a lazy index shares its file handle and decoded-quote cache with
+        # every reader on the loop, so it has to be written from the loop too
+        return not getattr(self.storage, 'lazy', False)
+
+    async def write_async(self, f, *args):
+        # runs f on a worker thread. the caller holds the write lock, so
+        # nothing changes the quotes underneath it; readers on the loop can
+        # carry on meanwhile.
+        if not self.offloadable():
+            return f(*args)
+        self.writing = True
+        future = asyncio.ensure_future(vebyastquotebot.executors.EXECUTORS.run_io(f, *args))
+        cancelled = False
+        try:
+            while not future.done():
+                try:
+                    await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    # the worker thread carries on regardless, so keep the
+                    # flag set (and the caller's lock held) until it's done
+                    cancelled = True
+        finally:
+            self.writing = False
+        if cancelled:
+            raise asyncio.CancelledError()
+        return future.result()
+
+    async def save_async(self, ops):
+        await self.write_async(self.persist, ops)
+        self.notify(ops)
+
+    def compact(self):
+        self.storage.compact(self.index)
+        self.signature = self.storage.signature()
+
+    def prepare_commit(self):
+        with vebyastquotebot.metrics.METRICS.timer('quotedb_export'):
+            files = self.storage.prepare_commit(self.index)
+        self.signature = self.storage.signature()
+        return files
+
+    async def prepare_commit_async(self):
+        async with self.get_write_lock():
+            return await self.write_async(self.prepare_commit)
+
+    def get_repo(self):
+        if self.repo is None:
+            self.repo = git.Repo(os.path.dirname(os.path.abspath(self.filename)))
+        return self.repo
+
+STORES = {}
+def shared_store(filename=QUOTES_FILENAME, storage=QuoteDBStorage.SNAPSHOT, **kwargs):
+    path = os.path.abspath(filename)
+    if path not in STORES:
+        STORES[path] = QuoteStore(path, make_storage(storage, path, **kwargs))
+    return STORES[path]
+
+# a unit of work against the shared QuoteStore. changes made through
+# add_quote/remove_quote are staged on the QuoteDB and only applied to the
+# shared copy on exit, all at once, so commands that await Discord while one
+# of these is open never see (or save, or roll back) each other's half-done
+# changes. use it as `async with` from coroutines: that holds the store's write
+# lock while the changes are applied and saved.
 class QuoteDB(object):
-    def __init__(self, docommit=QuoteDBCommit.LOG, commit_message=''):
+    def __init__(self, docommit=QuoteDBCommit.LOG, commit_message='', store=None, gitwriter=None):
+        self.store = store
+        self.gitwriter = gitwriter
+        # when a gitwriter is in use, this is a future that resolves to a
+        # status string once the commit (and push) has actually happened
+        self.git_status = None
         self.repo = None
-        self.quotes = None
         self.docommit = docommit
         self.commit_message = commit_message
         self.index = None
+        self.version = None
         self.changed = False
+        self.ops = []
+        # staged changes: quote id -> quote for adds, and ids to remove
+        self.added = collections.OrderedDict()
+        self.removed = set()
 
     def __enter__(self):
-        with open('quotes.json', 'r') as jsf:
-            self.quotes = json.load(jsf)
-        self.index = {q['id']: q for q in self.quotes}
-        self.repo = git.Repo(os.getcwd())
+        if self.store is None:
+            self.store = shared_store()
+        self.store.refresh()
+        self.index = self.store.index
+        self.version = self.store.version
         return self
 
+    async def __aenter__(self):
+        return self.__enter__()
+
+    @property
+    def quotes(self):
+        return self.store.quotes
+
+    @vebyastquotebot.metrics.METRICS.timed('quotedb_commit')
     def commit(self):
-        self.repo.index.add(['quotes.json'])
+        self.repo = self.store.get_repo()
+        self.repo.index.add(self.store.prepare_commit())
         self.repo.index.commit(self.commit_message)
 
+    @vebyastquotebot.metrics.METRICS.timed('quotedb_push')
     def push(self):
+        self.repo = self.store.get_repo()
         self.repo.remote().push()
 
+    def contains(self, quote_id):
+        if quote_id in self.added:
+            return True
+        return quote_id not in self.removed and quote_id in self.index
+
     def add_quote(self, json_obj):
-        self.quotes.append(json_obj)
+        self.added[json_obj['id']] = json_obj
+        self.removed.discard(json_obj['id'])
+        self.ops.append(vebyastquotebot.storage.add_op(json_obj))
         self.changed = True
 
     def remove_quote(self, quote_id):
-        before = len(self.quotes)
-        self.quotes = [quote for quote in self.quotes if quote['id'] != quote_id]
-        after = len(self.quotes)
-        self.changed = (before != after)
-
-    def __exit__(self, etype, value, traceback):
-        if etype:
+        if not self.contains(quote_id):
             return False
+        self.added.pop(quote_id, None)
+        self.removed.add(quote_id)
+        self.ops.append(vebyastquotebot.storage.remove_op(quote_id))
+        self.changed = True
+        return True
 
-        if not self.changed:
-            return
+    def remove_quotes(self, quote_ids):
+        # quote id -> whether it was found and removed, in the order given
+        results = collections.OrderedDict()
+        for quote_id in quote_ids:
+            # `/remove 1 1` removes quote 1 once; the second lookup would
+            # report it missing
+            if quote_id in results:
+                continue
+            results[quote_id] = self.remove_quote(quote_id)
+        return results
 
+    def apply_changes(self):
+        # applies the staged changes to the shared copy, if this commit level
+        # saves them at all
         if self.docommit == QuoteDBCommit.LOG:
             print("QuoteDB saving changes")
 
-        if self.docommit >= QuoteDBCommit.FS:
-            with open('quotes.json', 'w') as jsf:
-                json.dump(self.quotes, jsf, indent=2)
+        if self.docommit < QuoteDBCommit.FS:
+            return False
+
+        if self.store.version != self.version:
+            logging.info('quote database changed during command', extra = {'custom': {
+                'filename': self.store.filename,
+                'num_ops': len(self.ops),
+            }})
+
+        try:
+            self.ops = self.store.apply(self.ops)
+        except Exception:
+            self.store.invalidate()
+            raise
+        return True
+
+    def submit_commit(self):
+        if self.docommit >= QuoteDBCommit.COMMIT and self.gitwriter:
+            self.git_status = self.gitwriter.submit(
+                self.commit_message,
+                push=(self.docommit >= QuoteDBCommit.PUSH),
+            )
+            return
 
         if self.docommit >= QuoteDBCommit.COMMIT:
             self.commit()
@@ -66,6 +303,37 @@ class QuoteDB(object):
         if self.docommit >= QuoteDBCommit.PUSH:
             self.push()
 
+    def __exit__(self, etype, value, traceback):
+        if etype or not self.changed:
+            # staged changes never touched the shared copy, so there's
+            # nothing to roll back
+            return False
+
+        if not self.apply_changes():
+            return False
+        try:
+            self.store.save(self.ops)
+        except Exception:
+            # whatever made it into the shared copy but not onto disk has to go
+            self.store.invalidate()
+            raise
+        self.submit_commit()
+        return False
+
+    async def __aexit__(self, etype, value, traceback):
+        if etype or not self.changed:
+            return False
+        async with self.store.get_write_lock():
+            if not self.apply_changes():
+                return False
+            try:
+                await self.store.save_async(self.ops)
+            except Exception:
+                self.store.invalidate()
+                raise
+        self.submit_commit()
+        return False
+
 def message_to_json(log):
     return {
         'author': log.author.display_name,
@@ -0,0 +1,144 @@
+import asyncio
+import os
+import logging
+import whoosh
+import whoosh.index
+import whoosh.qparser
+import whoosh.fields
+import vebyastquotebot.executors
+import vebyastquotebot.quotedb
+
+# an on-disk full-text index over the saved quotes. it's a QuoteStore listener:
+# saved changes get written to it one quote at a time, and a full load only
+# adds or deletes whatever differs from what's already on disk, so the index
+# never has to be rebuilt from scratch.
+#
+# writing the index is the slow part of saving a quote, so once the loop is
+# running the writes go to the process pool, one after another in the order
+# they were made. searches wait for the writes ahead of them first.
+
+QUOTE_INDEX_DIRNAME = 'quotes.idx'
+PREVIEW_LENGTH = 80
+
+WHOOSH_QUOTE_SCHEMA = whoosh.fields.Schema(
+    quote_id=whoosh.fields.ID(stored=True, unique=True),
+    content=whoosh.fields.TEXT,
+    author=whoosh.fields.KEYWORD(lowercase=True, commas=True, scorable=True),
+    author_id=whoosh.fields.KEYWORD(commas=True),
+    server=whoosh.fields.TEXT,
+    channel=whoosh.fields.TEXT,
+    preview=whoosh.fields.STORED,
+)
+
+SEARCH_FIELDS = ['content', 'author', 'server', 'channel']
+
+def quote_document(quote):
+    lines = quote['lines']
+    return {
+        'quote_id': quote['id'],
+        'content': '\n'.join(line['content'] for line in lines),
+        'author': ','.join(sorted(set(line['author'] for line in lines))),
+        'author_id': ','.join(sorted(set(str(line['author_id']) for line in lines))),
+        'server': quote.get('server') or '',
+        'channel': quote.get('channel') or '',
+        'preview': vebyastquotebot.quotedb.format_quotehash(lines[0], short=PREVIEW_LENGTH) if lines else '',
+    }
+
+def write_changes(dirname, changes):
+    # changes is a list of (quote id, document), with None for the document
+    # when the quote was removed. this runs in a worker process, so it opens
+    # the index itself.
+    index = whoosh.index.open_dir(dirname)
+    writer = index.writer()
+    for (quote_id, document) in changes:
+        if document is None:
+            writer.delete_by_term('quote_id', quote_id)
+        else:
+            writer.update_document(**document)
+    writer.commit()
+
+class SearchPage(object):
+    def __init__(self, results, total, pagenum, pagecount):
+        self.results = results
+        self.total = total
+        self.pagenum = pagenum
+        self.pagecount = pagecount
+
+class QuoteIndex(object):
+    def __init__(self, dirname=QUOTE_INDEX_DIRNAME, executors=None):
+        self.dirname = dirname
+        self.executors = executors or vebyastquotebot.executors.EXECUTORS
+        # the last write handed to the pool, if any
+        self.writes = None
+        if whoosh.index.exists_in(dirname):
+            self.index = whoosh.index.open_dir(dirname)
+        else:
+            os.makedirs(dirname, exist_ok=True)
+            self.index = whoosh.index.create_in(dirname, WHOOSH_QUOTE_SCHEMA)
+
+    def indexed_ids(self):
+        with self.index.searcher() as searcher:
+            return set(term.decode('utf-8') for term in searcher.lexicon('quote_id'))
+
+    def quotes_loaded(self, index):
+        indexed = self.indexed_ids()
+        missing = [quote_id for quote_id in index if quote_id not in indexed]
+        extra = indexed.difference(index)
+        if not missing and not extra:
+            return
+        self.write(
+            [(quote_id, None) for quote_id in extra] +
+            [(quote_id, quote_document(index[quote_id])) for quote_id in missing]
+        )
+        logging.info('synced quote search index', extra = {'custom': {
+            'dirname': self.dirname,
+            'num_added': len(missing),
+            'num_deleted': len(extra),
+        }})
+
+    def quotes_changed(self, ops):
+        changes = []
+        for op in ops:
+            if op['op'] == 'add':
+                changes.append((op['quote']['id'], quote_document(op['quote'])))
+            elif op['op'] == 'remove':
+                changes.append((op['id'], None))
+        self.write(changes)
+
+    def write(self, changes):
+        loop = asyncio.get_event_loop()
+        if not loop.is_running():
+            # at startup, before there's anything else to do
+            write_changes(self.dirname, changes)
+            return
+        self.writes = asyncio.ensure_future(self.write_after(self.writes, changes))
+
+    async def write_after(self, previous, changes):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await self.executors.run_cpu(write_changes, self.dirname, changes)
+        except Exception as e:
+            logging.error('could not write quote search index', extra = {'custom': {
+                'dirname': self.dirname,
+                'num_changes': len(changes),
+                'error': str(e),
+            }})
+
+    async def flush(self):
+        if self.writes is not None:
+            await asyncio.wait([self.writes])
+
+    def search(self, querystring, pagenum=1, pagelen=5):
+        with self.index.searcher() as searcher:
+            query = whoosh.qparser.MultifieldParser(
+                SEARCH_FIELDS, self.index.schema
+            ).parse(querystring)
+            page = searcher.search_page(query, pagenum, pagelen=pagelen)
+            results = [dict(hit) for hit in page]
+            return SearchPage(
+                results=results,
+                total=page.total,
+                pagenum=page.pagenum,
+                pagecount=page.pagecount,
+            )
@@ -0,0 +1,267 @@
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import os
+import vebyastquotebot.compact
+import vebyastquotebot.quotedb
+import vebyastquotebot.quotesearch
+
+# everything the commands do to the quote database, as a handful of coroutines.
+# LocalQuotes does it in this process. when the bot runs as several gateway
+# shards, one writer process owns the quotes (and the git repo) and serves a
+# LocalQuotes over a unix socket; the shards use RemoteQuotes, which has the
+# same methods, so that only one process ever touches quotes.json.
+#
+# add and remove return a future for the git status, like QuoteDB.git_status
+# (or None when nothing gets committed).
+#
+# the wire protocol is one json object per line. requests look like
+# {"id": 1, "method": "add", "params": {...}}, and get exactly one
+# {"id": 1, "result": ...} or {"id": 1, "error": "..."} back. for add and
+# remove, a {"id": 1, "git_status": "..."} (or "git_error") follows once the
+# change has been committed.
+
+# a whole quote goes in one line, and asyncio's default line limit is 64KiB
+MAX_LINE = 2 ** 24
+
+class LocalQuotes(object):
+    def __init__(self, *, store, index, sampler, renders, gitwriter=None, docommit=vebyastquotebot.quotedb.QuoteDBCommit.LOG):
+        self.store = store
+        self.index = index
+        self.sampler = sampler
+        self.renders = renders
+        self.gitwriter = gitwriter
+        self.docommit = docommit
+
+    def quotedb(self, commit_message=''):
+        return vebyastquotebot.quotedb.QuoteDB(
+            docommit=self.docommit,
+            commit_message=commit_message,
+            store=self.store,
+            gitwriter=self.gitwriter,
+        )
+
+    # changes are shielded from cancellation: once one has started, it gets
+    # saved and committed even if whoever asked for it goes away (a shard
+    # disconnecting, say), rather than being abandoned halfway through a save
+
+    async def add(self, quote, commit_message):
+        return await asyncio.shield(self.add_unshielded(quote, commit_message))
+
+    async def add_unshielded(self, quote, commit_message):
+        async with self.quotedb(commit_message) as quote_db:
+            quote_db.add_quote(quote)
+        return quote_db.git_status
+
+    async def remove(self, quote_ids, commit_message):
+        # -> (quote id -> whether it was found, git status future)
+        return await asyncio.shield(self.remove_unshielded(quote_ids, commit_message))
+
+    async def remove_unshielded(self, quote_ids, commit_message):
+        async with self.quotedb(commit_message) as quote_db:
+            results = quote_db.remove_quotes(quote_ids)
+        return (results, quote_db.git_status)
+
+    async def get(self, quote_id):
+        with vebyastquotebot.quotedb.QuoteDB(
+                docommit=vebyastquotebot.quotedb.QuoteDBCommit.READONLY,
+                store=self.store,
+        ) as quote_db:
+            if quote_id not in quote_db.index:
+                return None
+            return vebyastquotebot.compact.to_json(quote_db.index[quote_id])
+
+    async def render(self, quote_id):
+        # -> the quote as a list of message-sized pages, or None if there's
+        # no such quote. the refresh picks up changes made by other processes
+        # (and clears the cache if there were any) before the cache is used.
+        self.store.refresh()
+        pages = self.renders.get(quote_id)
+        if pages is not None:
+            return pages
+        quote = await self.get(quote_id)
+        if quote is None:
+            return None
+        return self.renders.render(quote)
+
+    async def search(self, querystring, pagenum=1):
+        # so that a quote that was just added can be found
+        await self.index.flush()
+        return self.index.search(querystring, pagenum=pagenum)
+
+    async def sample(self, **filters):
+        # -> (quote id, quote), or (None, None) if nothing matches
+        quote_id = self.sampler.sample(**filters)
+        quote = await self.get(quote_id) if quote_id is not None else None
+        if quote is None:
+            return (None, None)
+        return (quote_id, quote)
+
+class QuoteServer(object):
+    def __init__(self, quotes):
+        self.quotes = quotes
+        self.connections = 0
+
+    async def serve(self, path):
+        if os.path.exists(path):
+            # left over from a writer that didn't shut down cleanly
+            os.unlink(path)
+        server = await asyncio.start_unix_server(self.handle_connection, path, limit=MAX_LINE)
+        logging.info('serving quotes', extra = {'custom': {
+            'path': path,
+        }})
+        return server
+
+    async def handle_connection(self, reader, writer):
+        self.connections += 1
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                # each request is its own task, so a slow add doesn't hold up
+                # a get behind it; QuoteDB serializes the writes itself. if
+                # the shard goes away these get cancelled, but the changes
+                # themselves are shielded and still go through
+                task = asyncio.ensure_future(self.handle_request(json.loads(line.decode('utf-8')), writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            self.connections -= 1
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    def send(self, writer, message):
+        writer.write(json.dumps(message).encode('utf-8') + b'\n')
+
+    async def handle_request(self, request, writer):
+        request_id = request['id']
+        try:
+            (result, git_status) = await self.dispatch(request['method'], request.get('params', {}))
+        except Exception as e:
+            logging.error('quote request failed', extra = {'custom': {
+                'method': request.get('method'),
+                'error': str(e),
+            }})
+            self.send(writer, {'id': request_id, 'error': str(e)})
+            return
+        self.send(writer, {'id': request_id, 'result': result, 'git': git_status is not None})
+        if git_status is not None:
+            try:
+                self.send(writer, {'id': request_id, 'git_status': await git_status})
+            except Exception as e:
+                self.send(writer, {'id': request_id, 'git_error': str(e)})
+
+    async def dispatch(self, method, params):
+        if method == 'add':
+            return (None, await self.quotes.add(params['quote'], params['commit_message']))
+        if method == 'remove':
+            (results, git_status) = await self.quotes.remove(params['quote_ids'], params['commit_message'])
+            return (list(results.items()), git_status)
+        if method == 'get':
+            return (await self.quotes.get(params['quote_id']), None)
+        if method == 'render':
+            return (await self.quotes.render(params['quote_id']), None)
+        if method == 'search':
+            page = await self.quotes.search(params['querystring'], pagenum=params['pagenum'])
+            return (vars(page), None)
+        if method == 'sample':
+            return (list(await self.quotes.sample(**params)), None)
+        raise ValueError('unknown method {}'.format(method))
+
+class RemoteQuotes(object):
+    def __init__(self, path):
+        self.path = path
+        self.ids = itertools.count(1)
+        self.writer = None
+        # request id -> future for its result
+        self.results = {}
+        # request id -> future for its git status
+        self.git_statuses = {}
+        self.lock = None
+
+    async def connect(self):
+        # created on first use so that it binds to the loop that's running
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.writer is None:
+                (reader, self.writer) = await asyncio.open_unix_connection(self.path, limit=MAX_LINE)
+                asyncio.ensure_future(self.read_responses(reader))
+
+    async def read_responses(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.dispatch_response(json.loads(line.decode('utf-8')))
+        finally:
+            # the writer went away; fail whatever was waiting on it, and
+            # connect again on the next request
+            self.writer = None
+            error = ConnectionError('lost connection to the quote writer')
+            for future in itertools.chain(self.results.values(), self.git_statuses.values()):
+                if not future.done():
+                    future.set_exception(error)
+            self.results.clear()
+            self.git_statuses.clear()
+
+    def dispatch_response(self, response):
+        request_id = response['id']
+        if 'git_status' in response or 'git_error' in response:
+            future = self.git_statuses.pop(request_id, None)
+            if future is None or future.done():
+                return
+            if 'git_error' in response:
+                future.set_exception(RuntimeError(response['git_error']))
+            else:
+                future.set_result(response['git_status'])
+            return
+
+        future = self.results.pop(request_id, None)
+        if future is None or future.done():
+            return
+        if 'error' in response:
+            future.set_exception(RuntimeError(response['error']))
+            return
+        if response.get('git'):
+            self.git_statuses[request_id] = asyncio.get_event_loop().create_future()
+        future.set_result((response['result'], self.git_statuses.get(request_id)))
+
+    async def call(self, method, **params):
+        await self.connect()
+        request_id = next(self.ids)
+        future = asyncio.get_event_loop().create_future()
+        self.results[request_id] = future
+        self.writer.write(json.dumps({'id': request_id, 'method': method, 'params': params}).encode('utf-8') + b'\n')
+        await self.writer.drain()
+        return await future
+
+    async def add(self, quote, commit_message):
+        (_, git_status) = await self.call('add', quote=quote, commit_message=commit_message)
+        return git_status
+
+    async def remove(self, quote_ids, commit_message):
+        (results, git_status) = await self.call('remove', quote_ids=list(quote_ids), commit_message=commit_message)
+        return (collections.OrderedDict(results), git_status)
+
+    async def get(self, quote_id):
+        (quote, _) = await self.call('get', quote_id=quote_id)
+        return quote
+
+    async def render(self, quote_id):
+        (pages, _) = await self.call('render', quote_id=quote_id)
+        return pages
+
+    async def search(self, querystring, pagenum=1):
+        (page, _) = await self.call('search', querystring=querystring, pagenum=pagenum)
+        return vebyastquotebot.quotesearch.SearchPage(**page)
+
+    async def sample(self, **filters):
+        (result, _) = await self.call('sample', **filters)
+        return tuple(result)
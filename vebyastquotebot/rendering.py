@@ -0,0 +1,88 @@
+import collections
+import vebyastquotebot.metrics
+import vebyastquotebot.quotedb
+
+# quotes as they get posted to discord. a message can only be 2000 characters
+# long, so a rendered quote is a list of pages, each short enough to go in a
+# message of its own with a line of header in front of it. pages break between
+# lines where they can, and only a single line that's too long for a page
+# gets cut up.
+#
+# rendering a quote is the same work every time it's shown, so the pages are
+# cached by quote id. the cache is a QuoteStore listener and forgets a quote
+# whenever it's removed or replaced.
+
+MESSAGE_LENGTH = 2000
+# leaves room for a header like 'Quote `<id>` (page 12/34):'
+PAGE_LENGTH = MESSAGE_LENGTH - 100
+
+def split_line(line, length):
+    # -> pieces of the line no longer than length, cut at whitespace when
+    # there's some in the back half of the piece
+    pieces = []
+    while len(line) > length:
+        cut = max(line.rfind(' ', length // 2, length), line.rfind('\n', length // 2, length))
+        if cut <= 0:
+            cut = length
+        pieces.append(line[:cut])
+        line = line[cut:].lstrip(' ')
+    pieces.append(line)
+    return pieces
+
+def paginate(lines, length=PAGE_LENGTH):
+    pages = []
+    page = []
+    page_length = 0
+    for line in lines:
+        for piece in split_line(line, length):
+            # +1 for the newline joining it to the line before
+            if page and page_length + 1 + len(piece) > length:
+                pages.append('\n'.join(page))
+                (page, page_length) = ([], 0)
+            page_length += len(piece) + (1 if page else 0)
+            page.append(piece)
+    if page or not pages:
+        pages.append('\n'.join(page))
+    return pages
+
+def render_quote(quote, length=PAGE_LENGTH):
+    return paginate([vebyastquotebot.quotedb.format_quotehash(line) for line in quote['lines']], length)
+
+class RenderCache(object):
+    def __init__(self, maxsize=1024, length=PAGE_LENGTH):
+        self.maxsize = maxsize
+        self.length = length
+        # quote id -> pages, least recently used first
+        self.pages = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, quote_id):
+        # -> the cached pages, or None
+        pages = self.pages.get(quote_id)
+        if pages is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.pages.move_to_end(quote_id)
+        return pages
+
+    def render(self, quote):
+        # renders the quote and caches the result, whether or not it was
+        # cached already
+        quote_id = quote['id']
+        with vebyastquotebot.metrics.METRICS.timer('render'):
+            pages = render_quote(quote, self.length)
+        self.pages[quote_id] = pages
+        if len(self.pages) > self.maxsize:
+            self.pages.popitem(last=False)
+        return pages
+
+    def quotes_loaded(self, index):
+        # anything could have changed underneath a reload
+        self.pages.clear()
+
+    def quotes_changed(self, ops):
+        for op in ops:
+            quote_id = op['quote']['id'] if op['op'] == 'add' else op.get('id')
+            self.pages.pop(quote_id, None)
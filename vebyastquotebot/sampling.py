@@ -0,0 +1,173 @@
+import bisect
+import collections
+import random
+
+# secondary indexes for picking random quotes, maintained as a QuoteStore
+# listener alongside the main id index. every filter has its own set of quote
+# ids that supports O(1) random choice, and the quoted dates are kept sorted so
+# a date range is two bisects.
+
+# how many random draws from the most selective filter to try before giving up
+# on luck and scanning it
+REJECTION_TRIES = 64
+
+class IdSet(object):
+    def __init__(self):
+        self.items = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def add(self, item):
+        if item in self.positions:
+            return
+        self.positions[item] = len(self.items)
+        self.items.append(item)
+
+    def discard(self, item):
+        position = self.positions.pop(item, None)
+        if position is None:
+            return
+        last = self.items.pop()
+        if position < len(self.items):
+            self.items[position] = last
+            self.positions[last] = position
+
+    def choice(self, rng):
+        return rng.choice(self.items)
+
+class DateRange(object):
+    # a slice of the sorted (quoted, id) list, looking enough like an IdSet
+    # for sampling purposes. `since` is inclusive and `until` exclusive.
+    def __init__(self, sorted_keys, since, until, quote_keys):
+        self.sorted_keys = sorted_keys
+        self.since = since
+        self.until = until
+        self.quote_keys = quote_keys
+        self.lo = 0 if since is None else bisect.bisect_left(sorted_keys, (since,))
+        self.hi = len(sorted_keys) if until is None else bisect.bisect_left(sorted_keys, (until,))
+
+    def __len__(self):
+        return max(self.hi - self.lo, 0)
+
+    def __contains__(self, item):
+        keys = self.quote_keys.get(item)
+        if keys is None:
+            return False
+        return ((self.since is None or keys.quoted >= self.since) and
+                (self.until is None or keys.quoted < self.until))
+
+    def __iter__(self):
+        return (quote_id for (_, quote_id) in self.sorted_keys[self.lo:self.hi])
+
+    def choice(self, rng):
+        return self.sorted_keys[rng.randrange(self.lo, self.hi)][1]
+
+def normalize_name(name):
+    return (name or '').strip().lstrip('#').lower()
+
+QuoteKeys = collections.namedtuple('QuoteKeys', ['author_ids', 'channel', 'server', 'quoted'])
+
+def quote_keys(quote):
+    return QuoteKeys(
+        author_ids=frozenset(str(line['author_id']) for line in quote['lines']),
+        channel=normalize_name(quote.get('channel')),
+        server=normalize_name(quote.get('server')),
+        quoted=quote.get('quoted') or '',
+    )
+
+class QuoteSampler(object):
+    def __init__(self, rng=None):
+        self.rng = rng or random.Random()
+        self.clear()
+
+    def clear(self):
+        self.all = IdSet()
+        self.by_author = collections.defaultdict(IdSet)
+        self.by_channel = collections.defaultdict(IdSet)
+        self.by_server = collections.defaultdict(IdSet)
+        # sorted (quoted timestamp, quote id) pairs. the timestamps are all
+        # naive utc isoformat strings, so they sort correctly as strings.
+        self.quoted_keys = []
+        self.keys = {}
+
+    def quotes_loaded(self, index):
+        self.clear()
+        for quote in index.values():
+            self.add(quote)
+
+    def quotes_changed(self, ops):
+        for op in ops:
+            if op['op'] == 'add':
+                self.add(op['quote'])
+            elif op['op'] == 'remove':
+                self.remove(op['id'])
+
+    def add(self, quote):
+        quote_id = quote['id']
+        if quote_id in self.keys:
+            self.remove(quote_id)
+        keys = quote_keys(quote)
+        self.keys[quote_id] = keys
+        self.all.add(quote_id)
+        for author_id in keys.author_ids:
+            self.by_author[author_id].add(quote_id)
+        self.by_channel[keys.channel].add(quote_id)
+        self.by_server[keys.server].add(quote_id)
+        bisect.insort(self.quoted_keys, (keys.quoted, quote_id))
+
+    def remove(self, quote_id):
+        keys = self.keys.pop(quote_id, None)
+        if keys is None:
+            return
+        self.all.discard(quote_id)
+        for author_id in keys.author_ids:
+            self.discard_from(self.by_author, author_id, quote_id)
+        self.discard_from(self.by_channel, keys.channel, quote_id)
+        self.discard_from(self.by_server, keys.server, quote_id)
+        i = bisect.bisect_left(self.quoted_keys, (keys.quoted, quote_id))
+        if i < len(self.quoted_keys) and self.quoted_keys[i] == (keys.quoted, quote_id):
+            del self.quoted_keys[i]
+
+    @staticmethod
+    def discard_from(sets, key, quote_id):
+        ids = sets.get(key)
+        if ids is not None:
+            ids.discard(quote_id)
+            if not ids:
+                del sets[key]
+
+    def sample(self, *, author_id=None, channel=None, server=None, since=None, until=None):
+        # returns a random quote id matching every filter given, or None
+        filters = []
+        if author_id is not None:
+            filters.append(self.by_author.get(str(author_id), IdSet()))
+        if channel is not None:
+            filters.append(self.by_channel.get(normalize_name(channel), IdSet()))
+        if server is not None:
+            filters.append(self.by_server.get(normalize_name(server), IdSet()))
+        if since is not None or until is not None:
+            filters.append(DateRange(self.quoted_keys, since, until, self.keys))
+        if not filters:
+            filters.append(self.all)
+
+        filters.sort(key=len)
+        (smallest, rest) = (filters[0], filters[1:])
+        if not smallest:
+            return None
+
+        for _ in range(REJECTION_TRIES):
+            quote_id = smallest.choice(self.rng)
+            if all(quote_id in f for f in rest):
+                return quote_id
+
+        # the filters barely overlap; fall back to looking at every candidate
+        matching = [quote_id for quote_id in smallest if all(quote_id in f for f in rest)]
+        return self.rng.choice(matching) if matching else None
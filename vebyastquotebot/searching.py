@@ -1,82 +1,272 @@
+import asyncio
 import whoosh
 import whoosh.index
 import whoosh.qparser
 import whoosh.fields
 import whoosh.filedb
 import whoosh.filedb.filestore
+import collections
+import logging
+import vebyastquotebot.logcache
+import vebyastquotebot.metrics
 import vebyastquotebot.quotedb
 
-WHOOSH_STORAGE = whoosh.filedb.filestore.RamStorage()
 WHOOSH_MESSAGE_SCHEMA = whoosh.fields.Schema(
-    content=whoosh.fields.TEXT,
-    message_id=whoosh.fields.ID(stored=True),
-    author=whoosh.fields.KEYWORD
+    content=whoosh.fields.TEXT(stored=True),
+    message_id=whoosh.fields.ID(stored=True, unique=True),
+    author=whoosh.fields.KEYWORD(stored=True),
 )
 
-async def pull_logs(*, client, limit, start_message=None, end_message=None, channel=None):
-    logs = []
-    if end_message:
-        logs.append(end_message)
-    # goes from end to start
-    async for log in client.logs_from(
-            channel or start_message.channel or end_message.channel,
-            limit=limit,
-            before=end_message,
-            after=start_message):
-        logs.append(log)
-    if start_message:
-        if (not end_message or (end_message.id != start_message.id)):
-            logs.append(start_message)
+# how many messages to ask for at a time when walking a quote's range
+LOG_PAGE_SIZE = 100
+
+class QuoteTooLong(Exception):
+    def __init__(self, max_lines):
+        super().__init__('more than {} lines between the start and end messages'.format(max_lines))
+        self.max_lines = max_lines
+
+async def pull_logs(*, client, start_message, end_message, channel=None, max_lines=None,
+                    page_size=LOG_PAGE_SIZE, cache=vebyastquotebot.logcache.HISTORY_CACHE):
+    # walks from end_message back to start_message (both included) and yields
+    # the messages a page at a time, newest first. the next page is already
+    # being fetched while the caller deals with the current one. raises
+    # QuoteTooLong rather than stopping short once there are more than
+    # `max_lines` messages.
+    channel = channel or end_message.channel or start_message.channel
+
+    def fetch(before):
+        return asyncio.ensure_future(cache.logs_from(
+            client,
+            channel,
+            limit=page_size,
+            before=before,
+            after=start_message,
+        ))
+
+    nlines = 1
+    yield [end_message]
+    if end_message.id == start_message.id:
+        return
+
+    next_page = fetch(end_message)
+    try:
+        while next_page is not None:
+            with vebyastquotebot.metrics.METRICS.timer('pull_logs'):
+                page = await next_page
+            # anything short of a full page means we've reached start_message
+            next_page = fetch(page[-1]) if len(page) == page_size else None
+            nlines += len(page)
+            if max_lines is not None and nlines + 1 > max_lines:
+                raise QuoteTooLong(max_lines)
+            if next_page is not None:
+                # let the request go out before handing over the page
+                await asyncio.sleep(0)
+            yield page
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+
+    yield [start_message]
+
+async def recent_logs(*, client, limit, channel, cache=vebyastquotebot.logcache.HISTORY_CACHE):
+    # the last `limit` messages in the channel, oldest first
+    logs = await cache.logs_from(client, channel, limit=limit)
     logs.reverse()
     return logs
 
 
-def search_messages(*,
-                    logs,
-                    querystring,
-                    predicate=lambda _: True):
-    idx = WHOOSH_STORAGE.create_index(WHOOSH_MESSAGE_SCHEMA)
-
-    writer = idx.writer()
-    for log in logs:
-        if predicate(log):
-            writer.add_document(
-                content=log.clean_content,
-                message_id=log.id,
-                author=log.author.display_name,
-            )
-    writer.commit()
+def message_document(log):
+    return {
+        'content': log.clean_content,
+        'message_id': log.id,
+        'author': log.author.display_name,
+    }
 
-    with idx.searcher() as searcher:
+@vebyastquotebot.metrics.METRICS.timed('search_messages')
+def search_messages(*,
+                    index,
+                    querystring):
+    with index.searcher() as searcher:
         query = whoosh.qparser.QueryParser(
-            'content', idx.schema
+            'content', index.schema
         ).parse(querystring)
         resultset = searcher.search(query)
-        results = [result['message_id'] for result in resultset]
+        results = [dict(result) for result in resultset]
     return results
 
 
+# a search index over the most recent `limit` messages of one channel. it gets
+# backfilled from the channel history once, and after that kept up to date from
+# the gateway events instead of being rebuilt for every query.
+class ChannelIndex(object):
+    def __init__(self, channel, limit, predicate):
+        self.channel = channel
+        self.limit = limit
+        self.predicate = predicate
+        self.index = whoosh.filedb.filestore.RamStorage().create_index(WHOOSH_MESSAGE_SCHEMA)
+        # message ids in the window, oldest first
+        self.window = collections.deque()
+        self.members = set()
+        # changes that haven't been written to the index yet. gateway events
+        # only queue things up; the writer runs when somebody actually searches.
+        self.pending_adds = collections.OrderedDict()
+        self.pending_deletes = set()
+        # false until the backfill is done, and again whenever we might have
+        # missed events (e.g. after a reconnect)
+        self.live = False
+
+    def __len__(self):
+        return len(self.window)
+
+    def backfill(self, logs):
+        self.index = whoosh.filedb.filestore.RamStorage().create_index(WHOOSH_MESSAGE_SCHEMA)
+        self.window.clear()
+        self.members.clear()
+        self.pending_adds.clear()
+        self.pending_deletes.clear()
+        for log in logs:
+            self.add_message(log)
+        self.flush()
+        self.live = True
+
+    def add_message(self, log):
+        self.window.append(log.id)
+        self.members.add(log.id)
+        if self.predicate(log):
+            self.pending_adds[log.id] = message_document(log)
+        while len(self.window) > self.limit:
+            evicted = self.window.popleft()
+            self.members.discard(evicted)
+            self.delete_message_id(evicted)
+
+    def edit_message(self, log):
+        if log.id not in self.members:
+            return
+        self.pending_deletes.discard(log.id)
+        if self.predicate(log):
+            self.pending_adds[log.id] = message_document(log)
+        else:
+            self.delete_message_id(log.id)
+
+    def delete_message_id(self, message_id):
+        self.pending_adds.pop(message_id, None)
+        self.pending_deletes.add(message_id)
+
+    def flush(self):
+        if not self.pending_adds and not self.pending_deletes:
+            return
+        writer = self.index.writer()
+        for message_id in self.pending_deletes:
+            writer.delete_by_term('message_id', message_id)
+        for document in self.pending_adds.values():
+            writer.update_document(**document)
+        writer.commit()
+        self.pending_adds.clear()
+        self.pending_deletes.clear()
+
+    def search(self, querystring):
+        self.flush()
+        return search_messages(index=self.index, querystring=querystring)
+
+
+# all of the channel indexes, least recently used first. once the total number
+# of messages held goes over `max_messages`, whole channels get evicted.
+class ChannelIndexCache(object):
+    def __init__(self, max_messages=20000):
+        self.max_messages = max_messages
+        self.indexes = collections.OrderedDict()
+        # channel id -> the backfill currently running for it, so that
+        # simultaneous lookups in one channel only pull the history once
+        self.backfills = {}
+
+    def size(self):
+        return sum(len(idx) for idx in self.indexes.values())
+
+    async def get(self, *, client, channel, limit, predicate):
+        idx = self.indexes.get(channel.id)
+        if idx is not None and idx.live and idx.limit >= limit:
+            self.indexes.move_to_end(channel.id)
+            return idx
+
+        backfill = self.backfills.get(channel.id)
+        if backfill is None:
+            backfill = asyncio.ensure_future(self.backfill(
+                client=client,
+                channel=channel,
+                limit=limit,
+                predicate=predicate,
+            ))
+            self.backfills[channel.id] = backfill
+            backfill.add_done_callback(lambda _: self.backfills.pop(channel.id, None))
+        # shielded, since other lookups might be waiting on the same backfill
+        return await asyncio.shield(backfill)
+
+    async def backfill(self, *, client, channel, limit, predicate):
+        # either we've never seen this channel or there's a gap in what we
+        # know about it, so pull the history again
+        logs = await recent_logs(
+            client=client,
+            limit=limit,
+            channel=channel,
+        )
+        idx = ChannelIndex(channel, limit, predicate)
+        idx.backfill(logs)
+        self.indexes[channel.id] = idx
+        self.indexes.move_to_end(channel.id)
+        self.evict(keep=channel.id)
+        logging.info('backfilled channel search index', extra = {'custom': {
+            'channel': channel.id,
+            'num_messages': len(idx),
+            'num_channels': len(self.indexes),
+        }})
+        return idx
+
+    def evict(self, keep=None):
+        while self.size() > self.max_messages and len(self.indexes) > 1:
+            channel_id = next(iter(self.indexes))
+            if channel_id == keep:
+                self.indexes.move_to_end(channel_id)
+                continue
+            del self.indexes[channel_id]
+
+    def on_message(self, message):
+        idx = self.indexes.get(message.channel.id)
+        if idx is not None and idx.live:
+            idx.add_message(message)
+
+    def on_message_edit(self, message):
+        idx = self.indexes.get(message.channel.id)
+        if idx is not None and idx.live:
+            idx.edit_message(message)
+
+    def on_message_delete(self, message):
+        idx = self.indexes.get(message.channel.id)
+        if idx is not None and idx.live:
+            idx.delete_message_id(message.id)
+
+    def mark_stale(self):
+        for idx in self.indexes.values():
+            idx.live = False
+
+CHANNEL_INDEXES = ChannelIndexCache()
+
+
 async def find_message(*,
                        client,
                        channel,
                        querystring,
                        limit,
-                       predicate=lambda _: True):
-    logs = await pull_logs(
+                       predicate=lambda _: True,
+                       indexes=CHANNEL_INDEXES):
+    idx = await indexes.get(
         client=client,
-        limit=limit,
         channel=channel,
-    )
-    logs_idx = {
-        log.id: log for log in logs
-    }
-
-    search_results = search_messages(
-        logs=logs,
-        querystring=querystring,
+        limit=limit,
         predicate=predicate,
     )
 
+    search_results = idx.search(querystring)
+
     if len(search_results) == 0:
         err = 'No posts matching query.'
         if querystring.isdigit():
@@ -84,11 +274,11 @@ async def find_message(*,
         return (None, err)
     elif len(search_results) > 1:
         resultstring = 'Multiple posts matching query:\n{}'.format(
-            vebyastquotebot.quotedb.format_messages(
-                (logs_idx[sr] for sr in search_results[:5]),
+            vebyastquotebot.quotedb.format_quotehashes(
+                search_results[:5],
                 short=80,
             )
         )
         return (None, resultstring)
     else:
-        return (await client.get_message(channel, search_results[0]), 'Found one post')
+        return (await client.get_message(channel, search_results[0]['message_id']), 'Found one post')
@@ -0,0 +1,229 @@
+import collections.abc
+import json
+import logging
+import os
+import sqlite3
+import vebyastquotebot.compact
+import vebyastquotebot.storage
+
+# a QuoteStore backend that keeps the quotes in sqlite instead of one big json
+# document. lookups are primary key queries, and changes made through the index
+# go into a single write transaction that save() commits, so a command only
+# ever touches the rows it changes. quotes.json is still what the web UI reads;
+# it's exported from the database right before each git commit.
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS quotes (
+    id TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    quoted TEXT,
+    server TEXT,
+    channel TEXT,
+    -- the whole quote as json, for quotes that aren't shaped like /add output
+    -- and so can't be split into columns without losing something
+    raw TEXT
+);
+CREATE INDEX IF NOT EXISTS quotes_position ON quotes (position);
+CREATE INDEX IF NOT EXISTS quotes_channel ON quotes (channel);
+CREATE INDEX IF NOT EXISTS quotes_quoted ON quotes (quoted);
+
+CREATE TABLE IF NOT EXISTS lines (
+    quote_id TEXT NOT NULL REFERENCES quotes (id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    author TEXT,
+    author_id TEXT,
+    timestamp TEXT,
+    edited TEXT,
+    content TEXT,
+    authorcolor TEXT,
+    attachments TEXT,
+    PRIMARY KEY (quote_id, idx)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS lines_author_id ON lines (author_id);
+'''
+
+# PRAGMA user_version once the database has been seeded from quotes.json
+SEEDED_VERSION = 1
+
+LINE_COLUMNS = ['author', 'author_id', 'timestamp', 'edited', 'content', 'authorcolor', 'attachments']
+
+def is_text(value):
+    # TEXT columns would quietly turn numbers into strings
+    return value is None or isinstance(value, str)
+
+def is_regular(quote):
+    if list(quote.keys()) != vebyastquotebot.compact.QUOTE_KEYS or not isinstance(quote['lines'], list):
+        return False
+    if not all(is_text(quote[key]) for key in ['quoted', 'server', 'channel']):
+        return False
+    return all(
+        isinstance(line, dict) and
+        list(line.keys()) == vebyastquotebot.compact.LINE_KEYS and
+        all(is_text(line[key]) for key in LINE_COLUMNS[:-1])
+        for line in quote['lines']
+    )
+
+def line_from_row(row):
+    line = dict(zip(LINE_COLUMNS, row))
+    line['attachments'] = json.loads(line['attachments'])
+    return line
+
+def quote_from_rows(row, lines):
+    (quote_id, quoted, server, channel, raw) = row
+    if raw is not None:
+        return json.loads(raw)
+    return {
+        'id': quote_id,
+        'lines': lines,
+        'quoted': quoted,
+        'server': server,
+        'channel': channel,
+    }
+
+class SQLiteQuoteIndex(collections.abc.MutableMapping):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def begin(self):
+        if not self.conn.in_transaction:
+            # take the write lock up front, so another process can't slip a
+            # write in between our read and our write
+            self.conn.execute('BEGIN IMMEDIATE')
+
+    def __getitem__(self, quote_id):
+        row = self.conn.execute(
+            'SELECT id, quoted, server, channel, raw FROM quotes WHERE id = ?', (quote_id,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(quote_id)
+        lines = [line_from_row(r) for r in self.conn.execute(
+            'SELECT {} FROM lines WHERE quote_id = ? ORDER BY idx'.format(', '.join(LINE_COLUMNS)),
+            (quote_id,),
+        )]
+        return quote_from_rows(row, lines)
+
+    def __contains__(self, quote_id):
+        return self.conn.execute('SELECT 1 FROM quotes WHERE id = ?', (quote_id,)).fetchone() is not None
+
+    def __setitem__(self, quote_id, quote):
+        quote = vebyastquotebot.compact.to_json(quote)
+        self.begin()
+        row = self.conn.execute('SELECT position FROM quotes WHERE id = ?', (quote_id,)).fetchone()
+        if row is not None:
+            # replacing a quote keeps its place, like it would in a dict
+            position = row[0]
+            self.conn.execute('DELETE FROM lines WHERE quote_id = ?', (quote_id,))
+            self.conn.execute('DELETE FROM quotes WHERE id = ?', (quote_id,))
+        else:
+            position = self.conn.execute('SELECT COALESCE(MAX(position), 0) + 1 FROM quotes').fetchone()[0]
+
+        if not is_regular(quote):
+            self.conn.execute(
+                'INSERT INTO quotes (id, position, quoted, server, channel, raw) VALUES (?, ?, ?, ?, ?, ?)',
+                (quote_id, position, quote.get('quoted'), quote.get('server'), quote.get('channel'), json.dumps(quote)),
+            )
+            return
+
+        self.conn.execute(
+            'INSERT INTO quotes (id, position, quoted, server, channel) VALUES (?, ?, ?, ?, ?)',
+            (quote_id, position, quote['quoted'], quote['server'], quote['channel']),
+        )
+        self.conn.executemany(
+            'INSERT INTO lines (quote_id, idx, {}) VALUES (?, ?, {})'.format(
+                ', '.join(LINE_COLUMNS), ', '.join('?' for _ in LINE_COLUMNS)),
+            [
+                [quote_id, idx] + [line[c] for c in LINE_COLUMNS[:-1]] + [json.dumps(line['attachments'])]
+                for (idx, line) in enumerate(quote['lines'])
+            ],
+        )
+
+    def __delitem__(self, quote_id):
+        self.begin()
+        self.conn.execute('DELETE FROM lines WHERE quote_id = ?', (quote_id,))
+        if self.conn.execute('DELETE FROM quotes WHERE id = ?', (quote_id,)).rowcount == 0:
+            raise KeyError(quote_id)
+
+    def __iter__(self):
+        return (row[0] for row in self.conn.execute('SELECT id FROM quotes ORDER BY position'))
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM quotes').fetchone()[0]
+
+    def items(self):
+        # two ordered scans merged together, instead of a query per quote
+        quotes = self.conn.cursor().execute(
+            'SELECT id, quoted, server, channel, raw FROM quotes ORDER BY position')
+        lines = self.conn.cursor().execute(
+            'SELECT lines.quote_id, {} FROM lines JOIN quotes ON quotes.id = lines.quote_id '
+            'ORDER BY quotes.position, lines.idx'.format(', '.join('lines.' + c for c in LINE_COLUMNS)))
+        pending = next(lines, None)
+        for row in quotes:
+            quote_lines = []
+            while pending is not None and pending[0] == row[0]:
+                quote_lines.append(line_from_row(pending[1:]))
+                pending = next(lines, None)
+            yield (row[0], quote_from_rows(row, quote_lines))
+
+    def values(self):
+        return (quote for (_, quote) in self.items())
+
+class SQLiteStorage(object):
+    def __init__(self, filename, db_filename=None):
+        self.filename = filename
+        self.db_filename = db_filename or os.path.splitext(filename)[0] + '.sqlite3'
+        # saves run on a worker thread while reads stay on the loop; sqlite
+        # serializes use of the connection itself
+        self.conn = sqlite3.connect(self.db_filename, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA foreign_keys = ON')
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.executescript(SCHEMA)
+
+    def signature(self):
+        # bumped whenever some other connection commits
+        return (self.conn.execute('PRAGMA data_version').fetchone()[0],)
+
+    def load(self):
+        if self.conn.in_transaction:
+            # whatever was never saved gets thrown away
+            self.conn.execute('ROLLBACK')
+        index = SQLiteQuoteIndex(self.conn)
+        if not self.seeded():
+            self.seed(index)
+        return index
+
+    def seeded(self):
+        # an empty database isn't necessarily a new one, since every quote
+        # could have been removed, and quotes.json is only exported at commit
+        # time so reseeding from it could bring removed quotes back
+        return self.conn.execute('PRAGMA user_version').fetchone()[0] >= SEEDED_VERSION
+
+    def seed(self, index):
+        # opened up front, since an empty quotes.json never starts one
+        index.begin()
+        quotes = []
+        # databases from before the marker existed only count as seeded if
+        # they have something in them
+        if len(index) == 0 and os.path.exists(self.filename):
+            with open(self.filename, 'r') as jsf:
+                quotes = json.load(jsf)
+            for quote in quotes:
+                index[quote['id']] = quote
+        self.conn.execute('PRAGMA user_version = {}'.format(SEEDED_VERSION))
+        self.conn.execute('COMMIT')
+        if not quotes:
+            return
+        logging.info('seeded quote database', extra = {'custom': {
+            'db_filename': self.db_filename,
+            'num_quotes': len(quotes),
+        }})
+
+    def save(self, index, ops):
+        if self.conn.in_transaction:
+            self.conn.execute('COMMIT')
+
+    def compact(self, index):
+        pass
+
+    def prepare_commit(self, index):
+        vebyastquotebot.storage.write_snapshot(self.filename, index.values())
+        return [self.filename]
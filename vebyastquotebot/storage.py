@@ -0,0 +1,202 @@
+import json
+import os
+import logging
+import collections
+import vebyastquotebot.compact
+import vebyastquotebot.quotecodecs
+import vebyastquotebot.streaming
+
+# the on-disk formats that a QuoteStore can sit on top of. every backend
+# produces the same quotes.json snapshot that the web UI reads; they only differ
+# in how individual changes get to disk between snapshots.
+
+def file_signature(filename):
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+def write_snapshot(filename, quotes, codec=vebyastquotebot.quotecodecs.JSON):
+    # write-then-rename so that a crash halfway through leaves the old snapshot
+    # intact instead of a truncated file. returns whatever the codec says about
+    # where each quote ended up.
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb' if codec.binary else 'w') as f:
+        offsets = codec.dump(quotes, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpname, filename)
+    return offsets
+
+def apply_ops(index, ops):
+    for op in ops:
+        if op['op'] == 'add':
+            index[op['quote']['id']] = vebyastquotebot.compact.from_json(op['quote'])
+        elif op['op'] == 'remove':
+            index.pop(op['id'], None)
+    return index
+
+def add_op(quote):
+    return {'op': 'add', 'quote': quote}
+
+def remove_op(quote_id):
+    return {'op': 'remove', 'id': quote_id}
+
+class SnapshotStorage(object):
+    # with `lazy`, loading only builds an id -> byte offset index and quotes
+    # get decoded as they're looked up, so memory use doesn't grow with the
+    # size of the archive. that needs the offsets only the JSON codec gives.
+    #
+    # `filename` is always the quotes.json the web UI reads. with any other
+    # codec the snapshot lives next to it (quotes.msgpack etc.), gets seeded
+    # from quotes.json if it doesn't exist yet, and quotes.json is exported
+    # from it before every commit.
+    def __init__(self, filename, lazy=False, codec=vebyastquotebot.quotecodecs.JSON):
+        if lazy and codec is not vebyastquotebot.quotecodecs.JSON:
+            raise ValueError('lazy loading only works with the JSON codec')
+        self.filename = filename
+        self.lazy = lazy
+        self.codec = codec
+        if codec is vebyastquotebot.quotecodecs.JSON:
+            self.snapshot_filename = filename
+        else:
+            self.snapshot_filename = os.path.splitext(filename)[0] + codec.suffix
+
+    def signature(self):
+        return (file_signature(self.snapshot_filename),)
+
+    def load(self):
+        # returns a quote id -> quote mapping, in file order
+        if self.lazy:
+            return vebyastquotebot.streaming.LazyQuoteIndex(
+                self.snapshot_filename,
+                vebyastquotebot.streaming.build_offset_index(self.snapshot_filename),
+            )
+        if os.path.exists(self.snapshot_filename):
+            codec = self.codec
+            filename = self.snapshot_filename
+        else:
+            codec = vebyastquotebot.quotecodecs.JSON
+            filename = self.filename
+        if codec is vebyastquotebot.quotecodecs.JSON:
+            # one quote at a time, so the whole decoded file never has to sit
+            # in memory next to the compacted index
+            return collections.OrderedDict(
+                (q['id'], vebyastquotebot.compact.from_json(q))
+                for q in vebyastquotebot.streaming.iter_quotes(filename)
+            )
+        with open(filename, 'rb' if codec.binary else 'r') as f:
+            return collections.OrderedDict(
+                (q['id'], vebyastquotebot.compact.from_json(q)) for q in codec.load(f)
+            )
+
+    def write(self, index):
+        offsets = write_snapshot(self.snapshot_filename, (
+            vebyastquotebot.compact.to_json(q) for q in index.values()
+        ), self.codec)
+        if isinstance(index, vebyastquotebot.streaming.LazyQuoteIndex):
+            index.rebase(offsets)
+
+    def export(self, index):
+        # brings quotes.json up to date for the web UI
+        if self.snapshot_filename != self.filename:
+            write_snapshot(self.filename, (
+                vebyastquotebot.compact.to_json(q) for q in index.values()
+            ))
+
+    def save(self, index, ops):
+        self.write(index)
+
+    def compact(self, index):
+        pass
+
+    def prepare_commit(self, index):
+        # returns the files that need to be added to git
+        self.export(index)
+        return [self.filename]
+
+class JournalStorage(SnapshotStorage):
+    def __init__(self, filename, journal_filename=None, compact_every=100, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.journal_filename = journal_filename or filename + '.journal'
+        self.compact_every = compact_every
+        self.pending = 0
+
+    def signature(self):
+        return (file_signature(self.snapshot_filename), file_signature(self.journal_filename))
+
+    def repair_journal(self):
+        # a crash in the middle of an append leaves a partial last line behind.
+        # cut it off, or the next append would carry on from the end of it and
+        # turn a good entry into part of a bad one.
+        try:
+            with open(self.journal_filename, 'rb+') as jf:
+                data = jf.read()
+                if not data or data.endswith(b'\n'):
+                    return
+                end = data.rfind(b'\n') + 1
+                jf.truncate(end)
+                jf.flush()
+                os.fsync(jf.fileno())
+        except FileNotFoundError:
+            return
+        logging.warning('truncated partial journal entry', extra = {'custom': {
+            'journal': self.journal_filename,
+            'num_bytes': len(data) - end,
+        }})
+
+    def read_journal(self):
+        ops = []
+        try:
+            with open(self.journal_filename, 'r') as jf:
+                for lineno, line in enumerate(jf):
+                    if not line.strip():
+                        continue
+                    try:
+                        ops.append(json.loads(line))
+                    except ValueError:
+                        # repair_journal cuts off a partial last line, so this
+                        # is something else; everything around it is still good
+                        logging.warning('ignoring corrupt journal entry', extra = {'custom': {
+                            'journal': self.journal_filename,
+                            'lineno': lineno,
+                        }})
+        except FileNotFoundError:
+            pass
+        return ops
+
+    def load(self):
+        index = super().load()
+        self.repair_journal()
+        ops = self.read_journal()
+        self.pending = len(ops)
+        return apply_ops(index, ops)
+
+    def save(self, index, ops):
+        with open(self.journal_filename, 'a') as jf:
+            for op in ops:
+                jf.write(json.dumps(op) + '\n')
+            jf.flush()
+            os.fsync(jf.fileno())
+        self.pending += len(ops)
+        if self.pending >= self.compact_every:
+            self.compact(index)
+
+    def compact(self, index):
+        self.write(index)
+        # only drop the journal once the snapshot containing it is safely on disk
+        with open(self.journal_filename, 'w'):
+            pass
+        logging.info('compacted quote journal', extra = {'custom': {
+            'journal': self.journal_filename,
+            'num_ops': self.pending,
+        }})
+        self.pending = 0
+
+    def prepare_commit(self, index):
+        # the web UI only reads the snapshot, so bring it up to date first
+        if self.pending:
+            self.compact(index)
+        self.export(index)
+        return [self.filename]
@@ -0,0 +1,171 @@
+import collections
+import collections.abc
+import json
+import mmap
+import os
+import re
+
+# reading and writing quotes.json one quote at a time. the reader finds the byte
+# span of each top-level element without decoding the rest of the file, which
+# is enough to build an id -> offset index and then decode single quotes on
+# demand. the writer produces exactly what json.dump(quotes, f, indent=2) would,
+# and reports where each quote ended up so the offsets stay usable.
+
+STRUCTURE = re.compile(rb'[{}\[\]"]')
+# the rest of a string after its opening quote, up to and including the
+# closing one
+STRING_REST = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+
+def iter_spans(buf):
+    # yields (start, end) for each element of the top-level array in `buf`
+    depth = 0
+    pos = 0
+    start = None
+    while True:
+        m = STRUCTURE.search(buf, pos)
+        if not m:
+            return
+        c = m.group()
+        pos = m.end()
+        if c == b'"':
+            rest = STRING_REST.match(buf, pos)
+            if not rest:
+                raise ValueError('unterminated string at byte {}'.format(m.start()))
+            pos = rest.end()
+            continue
+        if c in (b'{', b'['):
+            depth += 1
+            if depth == 2:
+                start = m.start()
+        else:
+            if depth == 2:
+                yield (start, pos)
+            depth -= 1
+
+def open_spans(filename):
+    # returns (mmap, spans); the mmap is None for an empty file, which mmap
+    # can't handle
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return (None, [])
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return (buf, list(iter_spans(buf)))
+
+DECODER = json.JSONDecoder()
+WHITESPACE = re.compile(r'\s*')
+
+def iter_quotes(filename):
+    # decodes the top-level array one element at a time. that still reads the
+    # whole file as text, but only one decoded quote is alive at once, and
+    # raw_decode is as fast as json.load where the span scan above is not.
+    with open(filename, 'r', encoding='utf-8') as f:
+        text = f.read()
+    pos = WHITESPACE.match(text).end()
+    if pos == len(text):
+        return
+    if text[pos] != '[':
+        raise ValueError('expected a JSON array at char {}'.format(pos))
+    pos = WHITESPACE.match(text, pos + 1).end()
+    if text.startswith(']', pos):
+        return
+    while True:
+        (quote, pos) = DECODER.raw_decode(text, pos)
+        yield quote
+        pos = WHITESPACE.match(text, pos).end()
+        if text.startswith(']', pos):
+            return
+        if not text.startswith(',', pos):
+            raise ValueError('expected , or ] at char {}'.format(pos))
+        pos = WHITESPACE.match(text, pos + 1).end()
+
+def build_offset_index(filename):
+    # quote id -> (start, end), in file order. only one quote is decoded at a
+    # time.
+    offsets = collections.OrderedDict()
+    (buf, spans) = open_spans(filename)
+    try:
+        for (start, end) in spans:
+            offsets[json.loads(buf[start:end].decode('utf-8'))['id']] = (start, end)
+    finally:
+        if buf is not None:
+            buf.close()
+    return offsets
+
+def write_quotes(f, quotes):
+    # equivalent to json.dump(list(quotes), f, indent=2) without building the
+    # list. returns quote id -> (start, end) of each quote in the output.
+    # json's default ensure_ascii means characters and bytes line up.
+    offsets = collections.OrderedDict()
+    pos = 0
+    first = True
+    for quote in quotes:
+        encoded = json.dumps(quote, indent=2).replace('\n', '\n  ')
+        prefix = '[\n  ' if first else ',\n  '
+        f.write(prefix)
+        f.write(encoded)
+        pos += len(prefix)
+        offsets[quote['id']] = (pos, pos + len(encoded))
+        pos += len(encoded)
+        first = False
+    f.write('[]' if first else '\n]')
+    return offsets
+
+
+# a quote id -> quote mapping backed by byte offsets into a snapshot file.
+# quotes are decoded when they're looked up, with a small cache for repeat
+# lookups. quotes added in memory are held as-is until the next snapshot gets
+# written, at which point `rebase` swaps everything back to offsets.
+class LazyQuoteIndex(collections.abc.MutableMapping):
+    def __init__(self, filename, offsets, cache_size=64):
+        self.filename = filename
+        self.entries = offsets
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.file = None
+
+    def read(self, span):
+        if self.file is None:
+            self.file = open(self.filename, 'rb')
+        (start, end) = span
+        self.file.seek(start)
+        return json.loads(self.file.read(end - start).decode('utf-8'))
+
+    def __getitem__(self, quote_id):
+        entry = self.entries[quote_id]
+        if not isinstance(entry, tuple):
+            return entry
+        if quote_id in self.cache:
+            self.cache.move_to_end(quote_id)
+            return self.cache[quote_id]
+        quote = self.read(entry)
+        self.cache[quote_id] = quote
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return quote
+
+    def __setitem__(self, quote_id, quote):
+        self.cache.pop(quote_id, None)
+        self.entries[quote_id] = quote
+
+    def __delitem__(self, quote_id):
+        self.cache.pop(quote_id, None)
+        del self.entries[quote_id]
+
+    def __contains__(self, quote_id):
+        return quote_id in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def rebase(self, offsets):
+        self.close()
+        self.entries = offsets
+        self.cache.clear()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -12,10 +12,28 @@ class ArgumentParserError(Exception):
 class ArgumentParserExited(Exception):
     pass
 
+# the outfile can also be swapped out for a single parse with parse_args_into,
+# which lets one parser get built up front and shared between invocations.
+
 class ThrowingArgumentParser(argparse.ArgumentParser):
-    def __init__(self, *args, outfile, **kwargs):
+    def __init__(self, *args, outfile=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.__outfile = outfile
+        self.__help = None
+
+    def parse_args_into(self, args, outfile):
+        previous = self.__outfile
+        self.__outfile = outfile
+        try:
+            return self.parse_args(args=args)
+        finally:
+            self.__outfile = previous
+
+    def format_help(self):
+        # the arguments don't change after setup, so neither does the help
+        if self.__help is None:
+            self.__help = super().format_help()
+        return self.__help
 
     def error(self, message):
         raise ArgumentParserError(message)